@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import textwrap
+import time
+from datetime import datetime, timedelta
+from io import StringIO
+
+from lxml import etree as ET
+
+from tcx import TCX, Workout, WorkoutStream
+
+
+class Generator:
+    """
+    Generator of synthetic TCX workouts.
+
+    Workouts consist of the given number of laps, tracks and trackpoints
+    recorded with the given sampling interval. Sensors present in the
+    trackpoints and the activity extensions are configurable,
+    so the generated files could mimic indoor and outdoor recordings
+    of different devices.
+    """
+
+    SENSORS = ("position", "altitude", "distance", "hr", "cadence", "watts")
+
+    __Header = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        "<TrainingCenterDatabase"
+        ' xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"'
+        ' xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2"'
+        ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+        "  <Activities>\n"
+        '    <Activity Sport="{sport}">\n'
+        "      <Id>{id}</Id>\n"
+    )
+    __Footer = (
+        '      <Creator xsi:type="Device_t">\n'
+        "        <Name>tcx-utils benchmark</Name>\n"
+        "        <UnitId>0</UnitId>\n"
+        "        <ProductID>0</ProductID>\n"
+        "        <Version>\n"
+        "          <VersionMajor>1</VersionMajor>\n"
+        "          <VersionMinor>0</VersionMinor>\n"
+        "        </Version>\n"
+        "      </Creator>\n"
+        "    </Activity>\n"
+        "  </Activities>\n"
+        "</TrainingCenterDatabase>\n"
+    )
+
+    def __init__(
+        self,
+        laps=1,
+        tracks=1,
+        trackpoints=600,
+        interval=1.0,
+        sensors=SENSORS,
+        extensions=True,
+        sport="Biking",
+    ):
+        self.laps = laps
+        self.tracks = tracks
+        self.trackpoints = trackpoints
+        self.interval = interval
+        self.sensors = set(sensors)
+        self.extensions = extensions
+        self.sport = sport
+
+    @property
+    def size(self):
+        """
+        Total number of trackpoints in the workout.
+        """
+        return self.laps * self.tracks * self.trackpoints
+
+    @property
+    def duration(self):
+        """
+        Duration of the workout.
+        """
+        return timedelta(seconds=self.size * self.interval)
+
+    def write(self, file, start_time=datetime(2020, 5, 8, 8, 0, 0)):
+        """
+        Writes the workout to the file.
+        """
+        with open(file, "w", encoding="utf-8") as f:
+            f.write(
+                Generator.__Header.format(
+                    sport=self.sport, id=TCX.to_tcx_time_string(start_time)
+                )
+            )
+
+            n, distance = 0, 0.0
+            for lap in range(self.laps):
+                lap_start, lap_distance = n, distance
+                body = StringIO()
+
+                for track in range(self.tracks):
+                    body.write("        <Track>\n")
+                    for _ in range(self.trackpoints):
+                        time = start_time + timedelta(seconds=n * self.interval)
+                        self._trackpoint(body, n, time, distance)
+                        distance += 8.0 * self.interval
+                        n += 1
+                    body.write("        </Track>\n")
+
+                lap_time = TCX.to_tcx_time_string(
+                    start_time + timedelta(seconds=lap_start * self.interval)
+                )
+                f.write(f'      <Lap StartTime="{lap_time}">\n')
+                f.write(
+                    "        <TotalTimeSeconds>{0:g}</TotalTimeSeconds>\n".format(
+                        (n - lap_start) * self.interval
+                    )
+                )
+                f.write(
+                    "        <DistanceMeters>{0:.1f}</DistanceMeters>\n".format(
+                        distance - lap_distance
+                    )
+                )
+                f.write("        <MaximumSpeed>9.0</MaximumSpeed>\n")
+                f.write("        <Calories>{0:d}</Calories>\n".format(n - lap_start))
+                if "hr" in self.sensors:
+                    f.write(
+                        "        <AverageHeartRateBpm><Value>140</Value>"
+                        "</AverageHeartRateBpm>\n"
+                        "        <MaximumHeartRateBpm><Value>170</Value>"
+                        "</MaximumHeartRateBpm>\n"
+                    )
+                f.write("        <Intensity>Active</Intensity>\n")
+                if "cadence" in self.sensors:
+                    f.write("        <Cadence>85</Cadence>\n")
+                f.write("        <TriggerMethod>Manual</TriggerMethod>\n")
+                f.write(body.getvalue())
+                f.write("      </Lap>\n")
+
+            f.write(Generator.__Footer)
+
+    def _trackpoint(self, f, n, time, distance):
+        sensors = self.sensors
+
+        f.write("          <Trackpoint>\n")
+        f.write(f"            <Time>{TCX.to_tcx_time_string(time)}</Time>\n")
+        if "position" in sensors:
+            f.write(
+                "            <Position>\n"
+                f"              <LatitudeDegrees>{50 + n * 1e-5:.7f}</LatitudeDegrees>\n"
+                f"              <LongitudeDegrees>{30 + n * 1e-5:.7f}</LongitudeDegrees>\n"
+                "            </Position>\n"
+            )
+        if "altitude" in sensors:
+            f.write(
+                f"            <AltitudeMeters>{100 + 10 * math.sin(n / 300):.1f}"
+                "</AltitudeMeters>\n"
+            )
+        if "distance" in sensors:
+            f.write(f"            <DistanceMeters>{distance:.1f}</DistanceMeters>\n")
+        if "hr" in sensors:
+            f.write(
+                "            <HeartRateBpm>\n"
+                f"              <Value>{130 + n % 40}</Value>\n"
+                "            </HeartRateBpm>\n"
+            )
+        if "cadence" in sensors:
+            f.write(f"            <Cadence>{80 + n % 15}</Cadence>\n")
+        if self.extensions:
+            f.write(
+                "            <Extensions>\n"
+                "              <ns3:TPX>\n"
+                "                <ns3:Speed>8.0</ns3:Speed>\n"
+            )
+            if "watts" in sensors:
+                f.write(f"                <ns3:Watts>{180 + n % 90}</ns3:Watts>\n")
+            f.write("              </ns3:TPX>\n" "            </Extensions>\n")
+        f.write("          </Trackpoint>\n")
+
+
+class Benchmark:
+    """
+    Repeatable benchmark of the workout operations.
+
+    For each size preset a workout and a set of single-lap segments
+    (used by merge) are generated into a temporary directory.
+    Each operation is timed separately from the setup it needs
+    (e.g. loading the workout before 'scale').
+    """
+
+    SIZES = {
+        "small": dict(laps=1, tracks=1, trackpoints=600, segments=4),
+        "medium": dict(laps=4, tracks=2, trackpoints=1800, segments=20),
+        "huge": dict(laps=6, tracks=1, trackpoints=20000, segments=100),
+    }
+
+    def __init__(self, sizes, repeat=3, sensors=Generator.SENSORS, extensions=True):
+        self.sizes = sizes
+        self.repeat = repeat
+        self.sensors = sensors
+        self.extensions = extensions
+
+    def run(self, log=sys.stderr):
+        """
+        Runs all the benchmarks and returns the report.
+        """
+        report = dict(
+            created=datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            python=platform.python_version(),
+            lxml=".".join(map(str, ET.LXML_VERSION)),
+            platform=platform.platform(),
+            repeat=self.repeat,
+            results=[],
+        )
+
+        for size in self.sizes:
+            with tempfile.TemporaryDirectory(prefix="tcx-bench-") as directory:
+                for name, setup, operation, meta in self._cases(size, directory):
+                    print(f"{size:>8} {name:<40}", end="", file=log, flush=True)
+                    timings = self._measure(setup, operation)
+                    result = dict(size=size, benchmark=name, **meta, **timings)
+                    report["results"].append(result)
+                    print(f"{timings['median']:.4f}s", file=log)
+
+        return report
+
+    def _cases(self, size, directory):
+        preset = dict(Benchmark.SIZES[size])
+        segments = preset.pop("segments")
+
+        workout = os.path.join(directory, "workout.tcx")
+        generator = Generator(
+            sensors=self.sensors, extensions=self.extensions, **preset
+        )
+        generator.write(workout)
+
+        segment_generator = Generator(
+            laps=1,
+            tracks=1,
+            trackpoints=max(1, generator.size // segments),
+            sensors=self.sensors,
+            extensions=self.extensions,
+        )
+        files, start = [], datetime(2020, 5, 8, 8, 0, 0)
+        for n in range(segments):
+            files.append(os.path.join(directory, f"segment{n:04d}.tcx"))
+            segment_generator.write(files[-1], start_time=start)
+            start += segment_generator.duration + timedelta(seconds=60)
+
+        meta = dict(
+            trackpoints=generator.size,
+            file_size=os.path.getsize(workout),
+        )
+        output = os.path.join(directory, "out.tcx")
+
+        def load():
+            return Workout.load(workout)
+
+        yield "load", None, lambda _: load(), meta
+        yield "info", load, lambda w: w.info(stream=StringIO()), meta
+        yield "info (stream)", None, lambda _: WorkoutStream(workout).summary(), meta
+        yield "scale", load, lambda w: w.scale(1.05), meta
+        yield "save", load, lambda w: w.save(output), meta
+
+        merge_meta = dict(
+            trackpoints=segment_generator.size * segments,
+            file_size=sum(os.path.getsize(f) for f in files),
+            segments=segments,
+        )
+        for kind in Workout.MergeKind:
+            yield (
+                f"merge_all ({kind.name.lower()})",
+                None,
+                lambda _, kind=kind: Workout.merge_all(files, merge_kind=kind),
+                merge_meta,
+            )
+
+    def _measure(self, setup, operation):
+        wall, cpu = [], []
+        for _ in range(self.repeat):
+            state = setup() if setup is not None else None
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            operation(state)
+            wall.append(time.perf_counter() - wall_start)
+            cpu.append(time.process_time() - cpu_start)
+
+        return dict(
+            min=min(wall),
+            median=statistics.median(wall),
+            mean=statistics.mean(wall),
+            max=max(wall),
+            cpu_median=statistics.median(cpu),
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark load, info, scale, merge and save of TCX workouts",
+        epilog=f"Example: {sys.argv[0]} -s small,medium -r 5 -o bench.json",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-s",
+        dest="sizes",
+        default="small,medium,huge",
+        help=textwrap.dedent(
+            """\
+            Comma separated list of workout sizes: {0}
+            Default: small,medium,huge
+            """.format(
+                ", ".join(Benchmark.SIZES)
+            )
+        ),
+    )
+    parser.add_argument(
+        "-r", dest="repeat", type=int, default=3, help="Number of repetitions"
+    )
+    parser.add_argument(
+        "--sensors",
+        dest="sensors",
+        default=",".join(Generator.SENSORS),
+        help="Comma separated list of trackpoint sensors: {0}".format(
+            ", ".join(Generator.SENSORS)
+        ),
+    )
+    parser.add_argument(
+        "--no-extensions",
+        dest="extensions",
+        action="store_false",
+        help="Do not generate trackpoint extensions",
+    )
+    parser.add_argument(
+        "-o", dest="output_file", help="Output JSON file. Default: stdout"
+    )
+    parser.add_argument(
+        "-g",
+        dest="generate",
+        metavar="FILE",
+        help=textwrap.dedent(
+            """\
+            Only generate a synthetic workout of the first size into the file.
+            Example:
+                ./bench.py -s huge -g huge.tcx
+            """
+        ),
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    sensors = [s.strip() for s in args.sensors.split(",") if s.strip()]
+
+    unknown = [s for s in sizes if s not in Benchmark.SIZES] + [
+        s for s in sensors if s not in Generator.SENSORS
+    ]
+    if unknown:
+        print(f"Unknown sizes or sensors: [{', '.join(unknown)}]", file=sys.stderr)
+        sys.exit(2)
+
+    if args.generate is not None:
+        preset = dict(Benchmark.SIZES[sizes[0]])
+        preset.pop("segments")
+        Generator(sensors=sensors, extensions=args.extensions, **preset).write(
+            args.generate
+        )
+        return
+
+    report = Benchmark(
+        sizes, repeat=args.repeat, sensors=sensors, extensions=args.extensions
+    ).run()
+
+    if args.output_file is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
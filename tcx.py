@@ -1,12 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import bz2
+import cProfile
+import csv
+import gzip
+import hashlib
+import heapq
+import json
+import lzma
+import math
+import mmap
+import os
 import textwrap
 import re
+import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
+import time
+import tracemalloc
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
+from array import array
+from contextlib import ExitStack, closing, contextmanager, nullcontext
 from enum import IntEnum, auto
+from functools import lru_cache, partial
+from bisect import bisect_right
+from itertools import accumulate, compress, islice, repeat
 from lxml import etree as ET
-from io import BytesIO
+from io import BytesIO, StringIO
+from operator import add, eq, gt, mul, ne, sub
 from datetime import datetime, timedelta
 
 
@@ -17,15 +43,92 @@ class TCX:
     XML based structured TCX files in form of ElementTree..
     """
 
-    __TimeFormats = [
-        "%Y-%m-%dT%H:%M:%S.%fZ",
-        "%Y-%m-%dT%H:%M:%SZ",
-    ]
+    ACTIVITY_EXTENSION = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
+
+    __TimeFormat = "%Y-%m-%dT%H:%M:%S.%fZ"
+    __TimePattern = re.compile(
+        r"\s*(\d{4}-\d\d-\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:[.,](\d+))?"
+        r"(?:[Zz]|([+-])(\d\d)(?::?(\d\d))?)?\s*$"
+    )
     __DisplayTimeFormat = "%Y-%m-%d %H:%M:%S (UTC)"
     __DisplayTimeOnly = "%H:%M:%S"
+    __Epoch = datetime(1970, 1, 1)
 
-    def __init__(self, root):
+    def __init__(self, root, parent=None):
         self._root = root
+        self._parent = parent
+        self._cache = {}
+
+    def cached(self, key, compute):
+        """
+        Returns the cached value for the given key.
+        The value is computed on the first access.
+        """
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = compute()
+            return value
+
+    def invalidate(self):
+        """
+        Drops cached values of the element and all its parents.
+        Should be called whenever the underlying tree is modified.
+        """
+        self._cache.clear()
+        if self._parent is not None:
+            self._parent.invalidate()
+
+    @property
+    def namespace(self):
+        """
+        Namespace of the root element.
+        Names of the TCX elements are resolved against this namespace.
+        """
+        return self.cached("namespace", lambda: ET.QName(self._element).namespace)
+
+    @property
+    def index(self):
+        """
+        Index of the direct children of the root element by their name.
+        Built once and cached until the element is modified.
+        """
+
+        def build():
+            index, prefix = {}, TCX.qualify("", self.namespace)
+            for child in self._element:
+                tag = child.tag
+                if isinstance(tag, str) and tag.startswith(prefix):
+                    index.setdefault(tag[len(prefix) :], []).append(child)
+            return index
+
+        return self.cached("index", build)
+
+    def child(self, name):
+        """
+        Returns the first direct child with the given name or None.
+        """
+        children = self.index.get(name)
+        return children[0] if children else None
+
+    def children(self, name):
+        """
+        Returns all direct children with the given name.
+        """
+        return iter(self.index.get(name, ()))
+
+    def select(self, path):
+        """
+        Finds all elements matching the given path (e.g. "Track/Trackpoint"),
+        resolving the names against the namespace of the root element.
+        """
+        return self._element.iterfind(TCX.qualify(path, self.namespace))
+
+    def select_one(self, path):
+        """
+        Finds the first element matching the given path or None.
+        """
+        return self._element.find(TCX.qualify(path, self.namespace))
 
     def elements(self, name, strict=True):
         """
@@ -53,17 +156,36 @@ class TCX:
         """
         self._root.set(name, value)
 
-    def get_child_attribute(self, child_tag, key):
+    def get_child_attribute(self, child_path, key):
         """
-        Returns given attribute of the first child with the given tag.
+        Returns given attribute of the first child matching the given path.
         """
-        return self.element(child_tag).get(key)
+        return self.select_one(child_path).get(key)
 
-    def set_child_attribute(self, child_tag, key, value):
+    def set_child_attribute(self, child_path, key, value):
         """
-        Sets value of the given attribute of the first child with the given tag.
+        Sets value of the given attribute of the first child matching the given path.
         """
-        return self.element(child_tag).set(key, value)
+        return self.select_one(child_path).set(key, value)
+
+    @property
+    def _element(self):
+        """
+        Root element of the wrapped tree.
+        """
+        root = self._root
+        return root.getroot() if isinstance(root, ET._ElementTree) else root
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def qualify(path, namespace):
+        """
+        Qualifies each name of the path with the namespace:
+            ("Track/Trackpoint", ns) => "{ns}Track/{ns}Trackpoint"
+        """
+        if not namespace:
+            return path
+        return "/".join(f"{{{namespace}}}{name}" for name in path.split("/"))
 
     @staticmethod
     def get_elements(root, name, strict=True):
@@ -91,6 +213,14 @@ class TCX:
             if predicate(name, elem.tag):
                 return elem
 
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def local_name(tag):
+        """
+        Returns tag name without the namespace.
+        """
+        return tag[tag.rfind("}") + 1 :]
+
     @staticmethod
     def sort_children_by(parent, key):
         """
@@ -102,14 +232,56 @@ class TCX:
     def parse_time(time_string):
         """
         Parses string representation of 'datetime' and returns
-        an instance of the 'datetime'.
+        an instance of the 'datetime' (UTC).
         """
-        for tf in TCX.__TimeFormats:
-            try:
-                return datetime.strptime(time_string, tf)
-            except:
-                pass
-        raise ValueError(f"Unable to parse time string: [{time_string}]")
+        date, seconds, microseconds, offset = TCX.__split_time(time_string)
+        return TCX.__Epoch + timedelta(
+            days=TCX.__epoch_days(date),
+            seconds=seconds - offset,
+            microseconds=microseconds,
+        )
+
+    @staticmethod
+    def parse_epoch(time_string):
+        """
+        Parses string representation of 'datetime' and returns
+        the number of seconds since the epoch (UTC).
+        """
+        date, seconds, microseconds, offset = TCX.__split_time(time_string)
+        return TCX.__epoch_days(date) * 86400 + seconds - offset + microseconds / 1e6
+
+    @staticmethod
+    def __split_time(time_string):
+        """
+        Splits fixed layout ISO-8601 time string
+        (e.g. '2020-05-08T23:25:52.123Z' or '2020-05-08T23:25:52+02:00')
+        into the date, seconds of the day, microseconds and UTC offset in seconds.
+        """
+        match = TCX.__TimePattern.match(time_string)
+        if match is None:
+            raise ValueError(f"Unable to parse time string: [{time_string}]")
+
+        date, hours, minutes, seconds, fraction, sign, oh, om = match.groups()
+        seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        microseconds = int(fraction[:6].ljust(6, "0")) if fraction else 0
+
+        offset = 0
+        if sign is not None:
+            offset = int(oh) * 3600 + (int(om) * 60 if om else 0)
+            offset = -offset if sign == "-" else offset
+
+        return date, seconds, microseconds, offset
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def __epoch_days(date_string):
+        """
+        Number of days since the epoch for the 'YYYY-MM-DD' date string.
+        """
+        date = datetime(
+            int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10])
+        )
+        return (date - TCX.__Epoch).days
 
     @staticmethod
     def to_tcx_time_string(dt: datetime):
@@ -117,7 +289,23 @@ class TCX:
         Converts an instance of the 'datetime' to 
         correctly formated TCX string representation.
         """
-        return dt.strftime(TCX.__TimeFormats[0])
+        return dt.strftime(TCX.__TimeFormat)
+
+    @staticmethod
+    def to_epoch(dt: datetime):
+        """
+        Converts an instance of the 'datetime' to
+        the number of seconds since the epoch (UTC).
+        """
+        return (dt - TCX.__Epoch).total_seconds()
+
+    @staticmethod
+    def from_epoch(seconds):
+        """
+        Converts the number of seconds since the epoch (UTC)
+        to an instance of the 'datetime'.
+        """
+        return TCX.__Epoch + timedelta(seconds=seconds)
 
     @staticmethod
     def to_ts(dt: datetime):
@@ -133,10 +321,43 @@ class TCX:
         """
         return dt.strftime(TCX.__DisplayTimeOnly)
 
+    @staticmethod
+    def to_iso(dt: datetime):
+        """
+        Converts an instance of the 'datetime' to ISO 8601 string (UTC)
+        used by the machine-readable output, or None if it is unknown.
+        """
+        return dt.strftime(TCX.__TimeFormat) if dt is not None else None
+
+    @staticmethod
+    def to_seconds(delta):
+        """
+        Number of seconds of the 'timedelta' or None if it is unknown.
+        """
+        return delta.total_seconds() if delta is not None else None
+
     @staticmethod
     def chop_ms(delta):
         return delta - timedelta(microseconds=delta.microseconds)
 
+    @staticmethod
+    def span(start_time, finish_time):
+        """
+        Time span between the start and finish time,
+        or None if any of them is unknown.
+        """
+        if start_time is None or finish_time is None:
+            return None
+        return timedelta(seconds=(finish_time - start_time).total_seconds())
+
+    @staticmethod
+    def total(values):
+        """
+        Sum of the values, or None if any of them is unknown.
+        """
+        values = list(values)
+        return None if None in values else sum(values)
+
 
 class Workout(TCX):
     """
@@ -192,28 +413,45 @@ class Workout(TCX):
         MERGE_INTO_SINGLE_LAP = 2
         MERGE_INTO_SINGLE_TRACK = 3
 
-    __Id = "Id"
-    __Activities = "Activities"
-    __Activity = "Activity"
+    __Id = "Activities/Activity/Id"
+    __Activity = "Activities/Activity"
     __Sport = "Sport"
-    __Lap = "Lap"
+    __Lap = "Activities/Activity/Lap"
     __Notes = "Notes"
 
-    def __init__(self, workout_root: ET._ElementTree):
+    def __init__(self, workout_root: ET._ElementTree, file=None):
+        self.__file = file
         super().__init__(workout_root)
 
+    @property
+    def _root(self):
+        """
+        Workout tree. Workouts loaded from the cache
+        parse their file on the first access to the tree.
+        """
+        if self.__tree is None and self.__file is not None:
+            self.__tree = Workout.parse(self.__file)
+        return self.__tree
+
+    @_root.setter
+    def _root(self, root):
+        self.__tree = root
+
     @property
     def laps(self):
         """
         Workout should have at least one lap, but it could have more.
         """
-        return (Lap(lap) for lap in self.elements(Workout.__Lap))
+        laps = self.cached(
+            "laps", lambda: [Lap(lap, self) for lap in self.select(Workout.__Lap)]
+        )
+        return iter(laps)
 
     @property
     def workout_id(self):
         """
         """
-        return self.element(Workout.__Id).text
+        return self.select_one(Workout.__Id).text
 
     @property
     def activity(self):
@@ -227,70 +465,97 @@ class Workout(TCX):
         """
         Workout start time.
         """
-        first_lap = sorted(self.laps, key=lambda lp: lp.start_time, reverse=False)[0]
-        return first_lap.start_time
+        return self.summary().start_time
 
     @property
     def finish_time(self):
         """
         Workout finish time.
         """
-        last_lap = sorted(self.laps, key=lambda lp: lp.finish_time, reverse=True)[0]
-        return last_lap.finish_time
+        return self.summary().finish_time
 
     @property
     def duration(self):
         """
         Workout duration.
         """
-        d = self.finish_time - self.start_time
-        return timedelta(seconds=d.total_seconds())
+        return self.summary().duration
 
     @classmethod
-    def load(cls, file):
+    def load(cls, file, cache=None):
         """
         Read and parse TCX file with workout data.
         Return root of the workout XML-tree.
+
+        With the cache, the summary of the workout is read from the cache
+        and the file is parsed only when the workout tree is accessed.
         """
-        return cls(ET.parse(file))
+        if cache is None:
+            return cls(cls.parse(file))
+
+        summary = cache.get(file)
+        if summary is not None:
+            workout = cls(None, file=file)
+            workout._cache["summary"] = summary
+            return workout
+
+        workout = cls(cls.parse(file))
+        cache.put(file, workout.summary())
+        return workout
+
+    @staticmethod
+    def parse(file):
+        """
+        Read and parse TCX file into the XML-tree.
+        """
+        profiler = Profiler.current
+        with open_input(file) as source, profiler.phase("parse"):
+            tree = ET.parse(source)
+
+        if profiler.enabled:
+            profiler.count("laps", tree.xpath("count(//*[local-name()='Lap'])"))
+            profiler.count(
+                "trackpoints", tree.xpath("count(//*[local-name()='Trackpoint'])")
+            )
+        return tree
 
     def save(self, file):
         """
         Save workout tree as TCX file.
-        """
-        encoding = "utf-8"
 
-        # Write to memory buffer, since ElementTree
-        # doesn't include XML declaration.
-        # Decode byte stream as a string and remove
-        # namespace (e.g. "<ns3:...>") information from the string.
-        mem_buf = BytesIO()
-        self._root.write(mem_buf, encoding=encoding, xml_declaration=True)
-        s = mem_buf.getvalue().decode(encoding)
-        s = re.sub(r"ns\d+:", "", s)
+        Elements are serialized incrementally straight to the file,
+        keeping TrainingCenterDatabase as the default namespace
+        and the prefixes of the extension namespaces.
+        """
+        with open_output(file) as f, Profiler.current.phase("serialize"):
+            writer = TCXWriter(f)
+            writer.declaration()
+            writer.write(self._element)
 
-        with open(file, "w") as f:
-            print(s, file=f)
+    def summary(self):
+        """
+        Summary of the workout, its laps and tracks.
+        Computed once and cached until the workout is modified.
+        """
+        return self.cached(
+            "summary",
+            lambda: WorkoutSummary(
+                self.workout_id, self.activity, [lap.summary() for lap in self.laps]
+            ),
+        )
 
     def info(self, prefix="", verbose=False, stream=sys.__stdout__):
         """
         Outputs workout info to a stream.
         """
-        print(prefix + "Workout:", file=stream)
-        prefix += "  "
-
-        print(prefix + "Id:           " + self.workout_id, file=stream)
-        print(prefix + "Activity:     " + self.activity, file=stream)
-        print(prefix + "Start time:   " + TCX.to_ts(self.start_time), file=stream)
-        print(prefix + "Finish time:  " + TCX.to_ts(self.finish_time), file=stream)
-        print(prefix + "Duration:     " + str(TCX.chop_ms(self.duration)), file=stream)
-
-        print(prefix + "Laps:         ", file=stream)
-        for n, lap in enumerate(self.laps):
-            lap.info(prefix=prefix + "  ", n=n, verbose=verbose, stream=stream)
+        self.summary().info(prefix=prefix, verbose=verbose, stream=stream)
 
-        print("", file=stream)
-        print("", file=stream)
+    def analyze(self, ftp=None):
+        """
+        Power, cadence and heart rate analytics of the workout:
+        best efforts, normalized power and, given FTP, intensity factor and TSS.
+        """
+        return WorkoutAnalysis.from_summary(self.summary(), ftp)
 
     def overlaps(self, workout):
         """
@@ -317,17 +582,34 @@ class Workout(TCX):
         with incorrectly calibrated indoor equipment or outdoor trackers.
         """
 
+        def scale(x):
+            return x * scale_factor
+
         for lap in self.laps:
-            for trackpoint in lap.trackpoints:
+            columns = lap.to_columns(nodes=True)
+
+            if scale_distance:
+                columns.update(Columns.DISTANCE, scale)
+
+            if scale_cadence:
+                columns.update(Columns.CADENCE, scale)
+
+            if scale_watts:
+                columns.update(Columns.WATTS, scale)
 
-                if scale_distance and trackpoint.distance is not None:
-                    trackpoint.distance = trackpoint.distance * scale_factor
+            lap.scale(scale_factor, distance=scale_distance, cadence=scale_cadence)
+            lap.recompute_stats(columns)
 
-                if scale_cadence and trackpoint.cadence is not None:
-                    trackpoint.cadence = trackpoint.cadence * scale_factor
+        self.invalidate()
 
-                if scale_watts and trackpoint.watts is not None:
-                    trackpoint.watts = trackpoint.watts * scale_factor
+    def recompute_lap_stats(self):
+        """
+        Derives heart rate, cadence and maximum speed of each lap
+        from its trackpoints (see Lap.recompute_stats).
+        """
+        for lap in self.laps:
+            lap.recompute_stats()
+        self.invalidate()
 
     def merge(self, workout, merge_kind=MergeKind.APPEND_LAPS):
         """
@@ -338,51 +620,118 @@ class Workout(TCX):
 
         if merge_kind == Workout.MergeKind.APPEND_LAPS:
             # Append all laps from the other workout to this workout
-            activity = self.element(Workout.__Activity)
+            self.__splice_laps([self, workout])
 
-            other_laps = workout.elements(Workout.__Lap)
-            activity.extend(other_laps)
+        else:
+            self_lap, workout_lap = self.__single_lap(), workout.__single_lap()
+            self_lap.merge(workout_lap, merge_kind=Lap.MergeKind(merge_kind))
 
-            # To avoid any possible inconsistencies we order laps by time
-            def predicate(child):
-                try:
-                    return Lap(child).start_time
-                except:
-                    return datetime.now()
+        self.invalidate()
+        workout.invalidate()
 
-            TCX.sort_children_by(activity, predicate)
+    def __single_lap(self):
+        """
+        Returns the only lap of the workout.
+        """
+        laps = list(self.laps)
+        if len(laps) != 1:
+            raise ValueError(
+                "In order to merge laps, each workout should have exactly one lap. "
+                "[{0}] workout has {1} laps.".format(self.workout_id, len(laps))
+            )
+        return laps[0]
 
-        else:
-            self_laps = list(self.laps)
-            workout_laps = list(workout.laps)
-
-            if len(self_laps) != 1 or len(workout_laps) != 1:
-                raise ValueError(
-                    "In order to merge laps, each workout should have exactly one lap. "
-                    "[{0}] workout has {2} laps, [{1}] workout has {3} laps.".format(
-                        self.workout_id,
-                        workout.workout_id,
-                        len(self_laps),
-                        len(workout_laps),
-                    )
-                )
+    def __splice_laps(self, workouts):
+        """
+        Moves laps of all the workouts to this workout,
+        placing them in place of the laps of this workout.
+        To avoid any possible inconsistencies laps are ordered by time.
+        """
+        activity = self.select_one(Workout.__Activity)
+        position = activity.index(next(self.laps)._root)
 
-            self_laps[0].merge(workout_laps[0], merge_kind=Lap.MergeKind(merge_kind))
+        laps = sorted(
+            (lap for workout in workouts for lap in workout.laps),
+            key=lambda lap: lap.start_time,
+        )
+        for lap in laps:
+            lap._root.getparent().remove(lap._root)
+        activity[position:position] = [lap._root for lap in laps]
 
     @staticmethod
     def overlap(*workouts):
         """
-        Returns True if any two workouts overlap.
+        Returns all the overlapping pairs of the workouts (files or loaded workouts)
+        as (workout, other workout, overlap duration) tuples.
+        The list is empty, i.e. false, if no two workouts overlap.
+
+        Only the metadata of the files is read, without loading them.
+        """
+        intervals = []
+        for w in workouts:
+            summary = (
+                w.summary() if isinstance(w, Workout) else WorkoutHeader(w).summary()
+            )
+            intervals.append((w, summary.start_time, summary.finish_time))
+        return list(Workout.overlapping(intervals))
+
+    @staticmethod
+    def overlapping(intervals):
+        """
+        Yields all the overlapping pairs of the (item, start time, finish time)
+        intervals together with the overlap duration.
+
+        Intervals are swept in the order of their start time, keeping the heap
+        of the active intervals ordered by finish time, so the pairs are found
+        in O(n log n + number of pairs). Intervals without time are ignored.
         """
-        pass
+        intervals = sorted(
+            (
+                (start, finish, n, item)
+                for n, (item, start, finish) in enumerate(intervals)
+                if start is not None and finish is not None
+            ),
+            key=lambda interval: interval[:3],
+        )
+
+        active = []
+        for start, finish, n, item in intervals:
+            while active and active[0][0] < start:
+                heapq.heappop(active)
+            for other_finish, _, other in active:
+                yield other, item, min(finish, other_finish) - start
+            heapq.heappush(active, (finish, n, item))
 
     @staticmethod
     def merge_all(workouts, merge_kind=MergeKind.APPEND_LAPS):
         """
+        Merge all the workouts (files or loaded workouts) into one workout.
+
+        Every workout is loaded and summarized once. Workouts are ordered
+        by start time and checked for overlaps in a single sweep,
+        then laps and tracks of all the workouts are spliced in one pass
+        into the earliest workout, which is returned.
         """
-        first, others = Workout.load(workouts[0]), workouts[1:]
-        for other in others:
-            first.merge(Workout.load(other), merge_kind=merge_kind)
+        workouts = sorted(
+            (w if isinstance(w, Workout) else Workout.load(w) for w in workouts),
+            key=lambda w: w.start_time,
+        )
+
+        finish_time = workouts[0].finish_time
+        for workout in workouts[1:]:
+            if workout.start_time <= finish_time:
+                raise ValueError("Workouts should not overlap")
+            finish_time = max(finish_time, workout.finish_time)
+
+        first = workouts[0]
+        if merge_kind == Workout.MergeKind.APPEND_LAPS:
+            first.__splice_laps(workouts)
+        else:
+            laps = [workout.__single_lap() for workout in workouts]
+            laps[0].merge_all(laps[1:], merge_kind=Lap.MergeKind(merge_kind))
+
+        for workout in workouts:
+            workout.invalidate()
         return first
 
 
@@ -400,27 +749,61 @@ class Lap(TCX):
     __StartTime = "StartTime"
     __TotalTime = "TotalTimeSeconds"
     __Distance = "DistanceMeters"
+    __MaxSpeed = "MaximumSpeed"
     __Calories = "Calories"
     __AverageHeartRate = "AverageHeartRateBpm"
     __MaxHeartRate = "MaximumHeartRateBpm"
     __Cadence = "Cadence"
+    __Value = "Value"
     __Track = "Track"
-    __Trackpoint = "Trackpoint"
+    __Trackpoint = "Track/Trackpoint"
+
+    # Order of the lap elements in the TCX schema
+    __Order = (
+        "TotalTimeSeconds",
+        "DistanceMeters",
+        "MaximumSpeed",
+        "Calories",
+        "AverageHeartRateBpm",
+        "MaximumHeartRateBpm",
+        "Intensity",
+        "Cadence",
+        "TriggerMethod",
+        "Track",
+        "Notes",
+        "Extensions",
+    )
 
-    def __init__(self, lap_root: ET._Element):
-        super().__init__(lap_root)
+    def __init__(self, lap_root: ET._Element, parent=None):
+        super().__init__(lap_root, parent)
 
     @property
     def tracks(self):
         """
         """
-        return (Track(t) for t in self.elements(Lap.__Track))
+        tracks = self.cached(
+            "tracks", lambda: [Track(t, self) for t in self.children(Lap.__Track)]
+        )
+        return iter(tracks)
 
     @property
     def trackpoints(self):
         """
         """
-        return (Trackpoint(tp) for tp in self.elements(Lap.__Trackpoint))
+        return (Trackpoint(tp, self) for tp in self.select(Lap.__Trackpoint))
+
+    @property
+    def columns(self):
+        """
+        Column-oriented view of all the lap trackpoints.
+        """
+        return self.cached("columns", self.to_columns)
+
+    def to_columns(self, nodes=False):
+        """
+        Parses all the lap trackpoints into the columns.
+        """
+        return Columns.from_trackpoints(self.select(Lap.__Trackpoint), nodes=nodes)
 
     @property
     def start_time(self):
@@ -434,87 +817,154 @@ class Lap(TCX):
         """
         time = Lap.to_tcx_time_string(x)
         self.set_attribute(Lap.__StartTime, time)
+        self.invalidate()
 
     @property
     def finish_time(self):
         """
         """
-        last_trackpoint = sorted(
-            self.trackpoints, key=lambda tp: tp.time, reverse=True
-        )[0]
-        return last_trackpoint.time
+        return self.summary().finish_time
 
     @property
     def duration(self):
         """
         Lap duration.
         """
-        d = self.finish_time - self.start_time
-        d = timedelta(seconds=d.total_seconds())
-        return d
+        return self.summary().duration
 
     @property
     def total_seconds(self):
         """
         Total lap time in seconds.
         """
-        return int(self.element(Lap.__TotalTime).text)
+        return int(float(self.child(Lap.__TotalTime).text))
 
     @total_seconds.setter
     def total_seconds(self, x):
         """
         """
-        time = self.element(Lap.__TotalTime)
+        time = self.child(Lap.__TotalTime)
         time.text = str(int(x))
+        self.invalidate()
 
     @property
     def distance(self):
         """
         Lap distance in meters.
         """
-        return float(self.element(Lap.__Distance).text)
+        return float(self.child(Lap.__Distance).text)
 
     @distance.setter
     def distance(self, x):
         """
         """
-        d = self.element(Lap.__Distance)
+        d = self.child(Lap.__Distance)
         d.text = str(float(x))
+        self.invalidate()
 
     @property
     def calories(self):
         """
         Lap calories.
         """
-        return float(self.element(Lap.__Calories).text)
+        return float(self.child(Lap.__Calories).text)
 
     @calories.setter
     def calories(self, x):
         """
         """
-        c = self.element(Lap.__Calories)
-        c.text = str(float(x))
+        c = self.child(Lap.__Calories)
+        c.text = str(int(round(x)))
+        self.invalidate()
+
+    @property
+    def max_speed(self):
+        """
+        Maximum lap speed in meters per second.
+        """
+        e = self.child(Lap.__MaxSpeed)
+        return float(e.text) if e is not None else None
+
+    @max_speed.setter
+    def max_speed(self, x):
+        """
+        """
+        self.__value_node(Lap.__MaxSpeed).text = str(float(x))
+        self.invalidate()
 
     @property
     def cadence(self):
         """
         """
-        e = self.element(Lap.__Cadence)
+        e = self.child(Lap.__Cadence)
         return int(float(e.text)) if e is not None else None
 
+    @cadence.setter
+    def cadence(self, x):
+        """
+        """
+        self.__value_node(Lap.__Cadence).text = str(int(round(x)))
+        self.invalidate()
+
     @property
     def heart_rate(self):
         """
         """
-        e = self.element(Lap.__AverageHeartRate)
-        return int(float(e[0].text)) if e is not None else None
+        e = self.child(Lap.__AverageHeartRate)
+        e = e.find(TCX.qualify(Lap.__Value, self.namespace)) if e is not None else None
+        return int(float(e.text)) if e is not None else None
+
+    @heart_rate.setter
+    def heart_rate(self, x):
+        """
+        """
+        self.__value_node(Lap.__AverageHeartRate, nested=True).text = str(int(round(x)))
+        self.invalidate()
 
     @property
     def max_heart_rate(self):
         """
         """
-        e = self.element(Lap.__MaxHeartRate)
-        return int(float(e[0].text)) if e is not None else None
+        e = self.child(Lap.__MaxHeartRate)
+        e = e.find(TCX.qualify(Lap.__Value, self.namespace)) if e is not None else None
+        return int(float(e.text)) if e is not None else None
+
+    @max_heart_rate.setter
+    def max_heart_rate(self, x):
+        """
+        """
+        self.__value_node(Lap.__MaxHeartRate, nested=True).text = str(int(round(x)))
+        self.invalidate()
+
+    def __value_node(self, name, nested=False):
+        """
+        Returns the node of the lap value, creating it at its place
+        in the TCX schema if it is missing. Heart rates keep the value
+        in the nested 'Value' node.
+        """
+        node = self.child(name)
+        if node is None:
+            lap, prefix = self._element, TCX.qualify("", self.namespace)
+            rank, position = Lap.__Order.index(name), len(lap)
+            for n, e in enumerate(lap):
+                if isinstance(e.tag, str) and e.tag.startswith(prefix):
+                    other = e.tag[len(prefix) :]
+                    if other in Lap.__Order and Lap.__Order.index(other) > rank:
+                        position = n
+                        break
+
+            node = lap.makeelement(TCX.qualify(name, self.namespace))
+            lap.insert(position, node)
+            self.invalidate()
+
+        if not nested:
+            return node
+
+        value = node.find(TCX.qualify(Lap.__Value, self.namespace))
+        if value is None:
+            value = node.makeelement(TCX.qualify(Lap.__Value, self.namespace))
+            node.append(value)
+        return value
 
     def overlaps(self, lap):
         """
@@ -524,41 +974,73 @@ class Lap(TCX):
             self.finish_time, lap.finish_time
         )
 
-    def info(self, prefix="  ", n="", verbose=False, stream=sys.__stdout__):
+    def scale(self, scale_factor, distance=True, cadence=True):
         """
-        Outputs lap info to a stream.
+        Scales distance, maximum speed and cadence of the lap totals.
+        The trackpoints are left intact.
         """
-        lap_title = "Lap" if n == "" else "Lap #{0:d}".format(n)
-        lap_title += " [{0} -> {1}]".format(
-            TCX.to_timeonly(self.start_time), TCX.to_timeonly(self.finish_time)
-        )
+        if distance:
+            self.distance = round(self.distance * scale_factor, 2)
+            if self.max_speed is not None:
+                self.max_speed = round(self.max_speed * scale_factor, 3)
 
-        print(prefix + lap_title, file=stream)
-        prefix += "  "
+        if cadence and self.cadence is not None:
+            self.cadence = self.cadence * scale_factor
 
-        print(prefix + "Start time:   " + TCX.to_ts(self.start_time), file=stream)
-        print(prefix + "Finish time:  " + TCX.to_ts(self.finish_time), file=stream)
-        print(prefix + "Duration:     " + str(TCX.chop_ms(self.duration)), file=stream)
-        print(prefix + "Distance:     " + f"{self.distance:,}m", file=stream)
-        print(prefix + "Calories:     " + str(self.calories), file=stream)
-        print(prefix + "Avg cadence:  " + str(self.cadence), file=stream)
+    def recompute_stats(self, columns=None):
+        """
+        Derives average and maximum heart rate, average cadence
+        and maximum speed of the lap from its trackpoints
+        in a single pass over the columns (parsed, if not given).
+        Values the trackpoints have no data for are kept as is.
+        Maximum speed is updated only if the lap reports it.
+        """
+        if columns is None:
+            columns = self.to_columns()
 
-        if self.heart_rate:
-            print(
-                prefix + "Avg HR:       " + str(self.heart_rate) + " bpm", file=stream
-            )
+        heart_rate = array("d", columns.present(Columns.HEART_RATE))
+        if heart_rate:
+            self.heart_rate = sum(heart_rate) / len(heart_rate)
+            self.max_heart_rate = max(heart_rate)
 
-        if self.max_heart_rate:
-            print(
-                prefix + "Max HR:       " + str(self.max_heart_rate) + " bpm",
-                file=stream,
-            )
+        cadence = array("d", columns.present(Columns.CADENCE))
+        if cadence:
+            self.cadence = sum(cadence) / len(cadence)
 
-        print(prefix + "Tracks:", file=stream)
-        for tn, track in enumerate(self.tracks):
-            track.info(prefix=prefix + "  ", n=tn, verbose=verbose, stream=stream)
+        if self.max_speed is not None:
+            max_speed = Lap.__max_speed(columns)
+            if max_speed is not None:
+                self.max_speed = round(max_speed, 3)
 
-        print("", file=stream)
+    @staticmethod
+    def __max_speed(columns):
+        """
+        Maximum speed between the consecutive trackpoints with distance.
+        """
+        time, distance = columns.mask(Columns.TIME), columns.mask(Columns.DISTANCE)
+        present = bytes(map(min, time, distance))
+        times = array("d", compress(columns.values(Columns.TIME), present))
+        distances = array("d", compress(columns.values(Columns.DISTANCE), present))
+
+        intervals = map(sub, times[1:], times[:-1])
+        covered = map(sub, distances[1:], distances[:-1])
+        return max((d / t for d, t in zip(covered, intervals) if t > 0), default=None)
+
+    def summary(self):
+        """
+        Summary of the lap and its tracks.
+        Computed once and cached until the lap is modified.
+        """
+        return self.cached(
+            "summary",
+            lambda: LapSummary.from_lap(self, [t.summary() for t in self.tracks]),
+        )
+
+    def info(self, prefix="  ", n="", verbose=False, stream=sys.__stdout__):
+        """
+        Outputs lap info to a stream.
+        """
+        self.summary().info(prefix=prefix, n=n, verbose=verbose, stream=stream)
 
     def merge(self, lap, merge_kind=MergeKind.MERGE_INTO_SINGLE_LAP):
         """
@@ -574,12 +1056,13 @@ class Lap(TCX):
         # Adjust distance of the trackpoints
         # from the later lap
         base_distance = earlier.distance
-        for trackpoint in later.trackpoints:
-            trackpoint.distance += base_distance
+        later.to_columns(nodes=True).update(
+            Columns.DISTANCE, lambda d: d + base_distance
+        )
 
         # Marge two laps into single lap
         if merge_kind == Lap.MergeKind.MERGE_INTO_SINGLE_LAP:
-            tracks = later.elements(Lap.__Track)
+            tracks = list(later.children(Lap.__Track))
             earlier._root.extend(tracks)
 
             # Copy the merged and adjusted tracks
@@ -588,24 +1071,70 @@ class Lap(TCX):
         # Merge multiple tracks into single track
         else:
             # Merge trackpoints
-            earlier_track = earlier.element(Lap.__Track)
-            later_trackpoints = list(later.elements(Lap.__Trackpoint))
+            earlier_track = earlier.child(Lap.__Track)
+            later_trackpoints = list(later.select(Lap.__Trackpoint))
             earlier_track.extend(later_trackpoints)
 
             # Copy the merged and adjusted trackpoints to this lap
-            self_track = self.element(Lap.__Track)
+            self_track = self.child(Lap.__Track)
             self_track[:] = earlier_track[:]
 
             # To avoid any possible inconsistencies we order merged trackpoints by time
-            TCX.sort_children_by(
-                self_track, lambda trackpoint: Trackpoint(trackpoint).time
-            )
+            Track(self_track).sort_trackpoints()
+
+        # Cached values no longer reflect the merged trees
+        self.invalidate()
+        lap.invalidate()
 
         self.start_time = earlier.start_time
         self.total_seconds += lap.total_seconds
         self.distance += lap.distance
         self.calories += lap.calories
-        # TODO: adjust max HR
+        self.recompute_stats()
+
+    def merge_all(self, laps, merge_kind=MergeKind.MERGE_INTO_SINGLE_LAP):
+        """
+        Merge the laps into this lap in one pass.
+        The laps are expected to be ordered by time, to follow this lap
+        and not to overlap each other.
+        """
+        total_seconds, distance, calories = (
+            self.total_seconds,
+            self.distance,
+            self.calories,
+        )
+        tracks = list(self.children(Lap.__Track))
+
+        for lap in laps:
+            # Adjust distance of the trackpoints
+            # by the distance of all the preceding laps
+            base_distance = distance
+            lap.to_columns(nodes=True).update(
+                Columns.DISTANCE, lambda d: d + base_distance
+            )
+
+            if merge_kind == Lap.MergeKind.MERGE_INTO_SINGLE_LAP:
+                # Place tracks right after the last track of this lap
+                for track in list(lap.children(Lap.__Track)):
+                    tracks[-1].addnext(track)
+                    tracks.append(track)
+            else:
+                tracks[0].extend(list(lap.select(Lap.__Trackpoint)))
+
+            total_seconds += lap.total_seconds
+            distance += lap.distance
+            calories += lap.calories
+            lap.invalidate()
+
+        if merge_kind == Lap.MergeKind.MERGE_INTO_SINGLE_TRACK:
+            # To avoid any possible inconsistencies we order merged trackpoints by time
+            Track(tracks[0], self).sort_trackpoints()
+
+        self.invalidate()
+        self.total_seconds = total_seconds
+        self.distance = distance
+        self.calories = calories
+        self.recompute_stats()
 
 
 class Track(TCX):
@@ -613,60 +1142,86 @@ class Track(TCX):
     """
 
     __Trackpoint = "Trackpoint"
+    __Time = "Trackpoint/Time"
+
+    def __init__(self, track_root: ET._Element, parent=None):
+        super().__init__(track_root, parent)
+
+    @property
+    def times(self):
+        """
+        Epoch times of the track trackpoints (array of doubles).
+        Parsed once and memoized until the track is modified.
+        """
+
+        def parse():
+            if "columns" in self._cache:
+                return self._cache["columns"].values(Columns.TIME)
+            return array(
+                "d", (TCX.parse_epoch(t.text) for t in self.select(Track.__Time))
+            )
 
-    def __init__(self, track_root: ET._Element):
-        super().__init__(track_root)
+        return self.cached("times", parse)
 
     @property
     def start_time(self):
         """
         """
-        first_trackpoint = sorted(
-            self.trackpoints, key=lambda tp: tp.time, reverse=False
-        )[0]
-        return first_trackpoint.time
+        return self.summary().start_time
 
     @property
     def finish_time(self):
         """
         """
-        last_trackpoint = sorted(
-            self.trackpoints, key=lambda tp: tp.time, reverse=True
-        )[0]
-        return last_trackpoint.time
+        return self.summary().finish_time
 
     @property
     def duration(self):
         """
         Track duration.
         """
-        d = self.finish_time - self.start_time
-        d = timedelta(seconds=d.total_seconds())
-        return d
+        return self.summary().duration
 
     @property
     def trackpoints(self):
         """
         """
-        return (Trackpoint(tp) for tp in self.elements(Track.__Trackpoint))
+        return (Trackpoint(tp, self) for tp in self.children(Track.__Trackpoint))
 
-    def info(self, prefix="  ", n=0, verbose=False, stream=sys.__stdout__):
+    @property
+    def columns(self):
         """
+        Column-oriented view of all the track trackpoints.
         """
-        track_title = "Track #{0:d} [{1} -> {2}]".format(
-            n, TCX.to_timeonly(self.start_time), TCX.to_timeonly(self.finish_time)
-        )
-        print(prefix + track_title, file=stream)
+        return self.cached("columns", self.to_columns)
 
-        prefix += "  "
-        print(prefix + "Start time:   " + TCX.to_ts(self.start_time), file=stream)
-        print(prefix + "Finish time:  " + TCX.to_ts(self.finish_time), file=stream)
-        print(prefix + "Duration:     " + str(TCX.chop_ms(self.duration)), file=stream)
-        print(prefix + "Trackpoints:  " + str(len(list(self.trackpoints))), file=stream)
+    def to_columns(self, nodes=False):
+        """
+        Parses all the track trackpoints into the columns.
+        """
+        return Columns.from_trackpoints(self.children(Track.__Trackpoint), nodes=nodes)
 
-        if verbose:
-            for t in self.trackpoints:
-                t.info(prefix + "  ", verbose=verbose, stream=stream)
+    def sort_trackpoints(self):
+        """
+        Orders trackpoints of the track by time.
+        """
+        trackpoints = list(self.children(Track.__Trackpoint))
+        times = self.times
+        order = sorted(range(len(trackpoints)), key=times.__getitem__)
+        self._root[:] = [trackpoints[i] for i in order]
+        self.invalidate()
+
+    def summary(self):
+        """
+        Summary of the track.
+        Computed once and cached until the track is modified.
+        """
+        return self.cached("summary", lambda: TrackSummary.from_columns(self.columns))
+
+    def info(self, prefix="  ", n=0, verbose=False, stream=sys.__stdout__):
+        """
+        """
+        self.summary().info(prefix=prefix, n=n, verbose=verbose, stream=stream)
 
 
 class Trackpoint(TCX):
@@ -675,201 +1230,4612 @@ class Trackpoint(TCX):
 
     __Time = "Time"
     __HeartRate = "HeartRateBpm"
+    __Value = "Value"
+    __Position = "Position"
+    __Latitude = "LatitudeDegrees"
+    __Longitude = "LongitudeDegrees"
     __Distance = "DistanceMeters"
     __Cadence = "Cadence"
-    __Watts = "Watts"
+    __Extensions = "Extensions"
+    __Watts = "TPX/Watts"
+    __Order = (
+        "Time",
+        "Position",
+        "AltitudeMeters",
+        "DistanceMeters",
+        "HeartRateBpm",
+        "Cadence",
+        "SensorState",
+        "Extensions",
+    )
+    __ExtensionOrder = ("Speed", "RunCadence", "Watts")
 
-    def __init__(self, trackpoint_root: ET._Element):
-        super().__init__(trackpoint_root)
+    def __init__(self, trackpoint_root: ET._Element, parent=None):
+        super().__init__(trackpoint_root, parent)
 
     @property
     def time(self):
         """
         Timestamp (datetime)
         """
-        return TCX.parse_time(self.element(Trackpoint.__Time).text)
+        return TCX.parse_time(self.child(Trackpoint.__Time).text)
+
+    @time.setter
+    def time(self, x):
+        node = self.child(Trackpoint.__Time)
+        node.text = TCX.to_tcx_time_string(x)
+        self.invalidate()
 
     @property
     def distance(self):
         """
         Distance in meters (float)
         """
-        node = self.element(Trackpoint.__Distance)
+        node = self.child(Trackpoint.__Distance)
         return float(node.text) if node is not None else None
 
     @distance.setter
     def distance(self, x):
-        node = self.element(Trackpoint.__Distance)
+        node = self.child(Trackpoint.__Distance)
+        if node is None:
+            # Added at its place in the TCX schema, e.g. before the heart rate
+            root = self._element
+            node = root.makeelement(TCX.qualify(Trackpoint.__Distance, self.namespace))
+            Trackpoint.__place(root, node, Trackpoint.__Order)
         node.text = str(float(x))
+        self.invalidate()
+
+    @property
+    def heart_rate(self):
+        """
+        Heart rate in bpm (int)
+        """
+        node = self._heart_rate_node()
+        return int(float(node.text)) if node is not None else None
+
+    @heart_rate.setter
+    def heart_rate(self, x):
+        node = self._heart_rate_node()
+        node.text = str(int(round(x)))
+        self.invalidate()
+
+    @property
+    def position(self):
+        """
+        Latitude and longitude in degrees (tuple of floats) or None
+        """
+        node = self.child(Trackpoint.__Position)
+        if node is None:
+            return None
+
+        namespace = self.namespace
+        latitude = node.find(TCX.qualify(Trackpoint.__Latitude, namespace))
+        longitude = node.find(TCX.qualify(Trackpoint.__Longitude, namespace))
+        if latitude is None or longitude is None:
+            return None
+        return float(latitude.text), float(longitude.text)
 
     @property
     def cadence(self):
         """
         Cadence (float)
         """
-        node = self.element(Trackpoint.__Cadence)
+        node = self.child(Trackpoint.__Cadence)
         return float(node.text) if node is not None else None
 
     @cadence.setter
     def cadence(self, x):
-        node = self.element(Trackpoint.__Cadence)
-        node.text = str(float(x))
+        node = self.child(Trackpoint.__Cadence)
+        node.text = str(int(round(x)))
+        self.invalidate()
 
     @property
     def watts(self):
         """
         Watts (float)
         """
-        node = self.element(Trackpoint.__Watts)
+        node = self._watts_node()
         return float(node.text) if node is not None else None
 
     @watts.setter
     def watts(self, x):
-        node = self.element(Trackpoint.__Watts)
+        node = self._watts_node()
         node.text = str(float(x))
+        self.invalidate()
 
-    def info(self, prefix="  ", verbose=False, stream=sys.__stdout__):
+    def scale(self, scale_factor, distance=True, cadence=True, watts=True):
         """
+        Scales distance, cadence and watts of the trackpoint.
+        The nodes are found directly, without indexing all the children,
+        as this is the hot path of the streaming scale.
         """
-        trackpoint_info = f"{TCX.to_timeonly(self.time)} -> {int(self.distance):,}m;"
+        root, namespace, nodes = self._element, self.namespace, []
+        if distance:
+            nodes.append(root.find(TCX.qualify(Trackpoint.__Distance, namespace)))
+        if watts:
+            extensions = root.find(TCX.qualify(Trackpoint.__Extensions, namespace))
+            if extensions is not None:
+                nodes.append(Trackpoint.find_watts(extensions))
+
+        for node in nodes:
+            if node is not None and node.text is not None:
+                node.text = str(float(node.text) * scale_factor)
+        if cadence:
+            # Cadence is an integer in the TCX schema
+            node = root.find(TCX.qualify(Trackpoint.__Cadence, namespace))
+            if node is not None and node.text is not None:
+                node.text = str(round(float(node.text) * scale_factor))
+        self.invalidate()
+
+    def fuse(self, trackpoint):
+        """
+        Adds the values the trackpoint lacks from the other trackpoint,
+        e.g. power and cadence of a trainer to a trackpoint of a watch,
+        at their place in the TCX schema. Values of the activity extension
+        are fused one by one. Nodes are moved from the other trackpoint.
+        """
+        root, other = self._element, trackpoint._element
+        Trackpoint.__fuse(root, other, Trackpoint.__Order)
 
-        if self.watts is not None:
-            trackpoint_info += f" {int(self.watts)}W;"
+        tag = TCX.qualify(Trackpoint.__Extensions, self.namespace)
+        extensions, other = root.find(tag), other.find(tag)
+        if extensions is not None and other is not None and len(other):
+            if len(extensions) and extensions[0].tag == other[0].tag:
+                Trackpoint.__fuse(extensions[0], other[0], Trackpoint.__ExtensionOrder)
+        self.invalidate()
+        trackpoint.invalidate()
 
-        if self.cadence is not None:
-            trackpoint_info += f" Cadence: {int(self.cadence)};"
+    @staticmethod
+    def __fuse(parent, other, order):
+        """
+        Moves the children of the other element that are in the order
+        and missing in the parent into the parent.
+        """
+        present = {TCX.local_name(n.tag) for n in parent if isinstance(n.tag, str)}
+        for node in list(other):
+            if isinstance(node.tag, str):
+                name = TCX.local_name(node.tag)
+                if name in order and name not in present:
+                    Trackpoint.__place(parent, node, order)
+
+    @staticmethod
+    def __place(parent, node, order):
+        """
+        Moves the node into the parent after the last child
+        that precedes it in the order, indented as its siblings.
+        Children are scanned from the end, where the values are usually added.
+        """
+        rank, position = order.index(TCX.local_name(node.tag)), 0
+        for n, child in enumerate(reversed(parent)):
+            if not isinstance(child.tag, str):
+                continue
+            name = TCX.local_name(child.tag)
+            if name in order and order.index(name) < rank:
+                position = len(parent) - n
+                break
+
+        if position < len(parent):
+            node.tail = parent.text
+        elif len(parent):
+            node.tail, parent[-1].tail = parent[-1].tail, parent.text
+        parent.insert(position, node)
+
+    def _heart_rate_node(self):
+        """
+        Value node of the heart rate or None.
+        """
+        node = self.child(Trackpoint.__HeartRate)
+        if node is None:
+            return None
+        return node.find(TCX.qualify(Trackpoint.__Value, self.namespace))
+
+    def _watts_node(self):
+        """
+        Watts node of the activity extension or None.
+        """
+        extensions = self.child(Trackpoint.__Extensions)
+        return Trackpoint.find_watts(extensions) if extensions is not None else None
+
+    @staticmethod
+    def find_watts(extensions):
+        """
+        Finds Watts node of the activity extension under the 'Extensions' node.
+        Files saved by the earlier versions of this tool have the extension
+        prefixes stripped, so Watts is also looked up in the namespace
+        of the 'Extensions' node itself.
+        """
+        watts = extensions.find(TCX.qualify(Trackpoint.__Watts, TCX.ACTIVITY_EXTENSION))
+        if watts is None:
+            namespace = ET.QName(extensions).namespace
+            watts = extensions.find(TCX.qualify(Trackpoint.__Watts, namespace))
+        return watts
 
+    def info(self, prefix="  ", verbose=False, stream=sys.__stdout__):
+        """
+        """
+        trackpoint_info = Trackpoint.describe(
+            self.time, self.distance, self.watts, self.cadence
+        )
         print(prefix + trackpoint_info, file=stream)
 
+    @staticmethod
+    def describe(time, distance, watts=None, cadence=None):
+        """
+        Returns one line human readable description of a trackpoint.
+        """
+        trackpoint_info = f"{TCX.to_timeonly(time)} -> {int(distance):,}m;"
 
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Scale, concatenate and modify TCX files",
-        epilog=f"Example: {sys.argv[0]} -m append_laps activity1.tcx activity2.tcx",
-        formatter_class=argparse.RawTextHelpFormatter,
-    )
+        if watts is not None:
+            trackpoint_info += f" {int(watts)}W;"
 
-    # ----------------------
-    # -- Exclusive actions
+        if cadence is not None:
+            trackpoint_info += f" Cadence: {int(cadence)};"
 
-    action = parser.add_argument_group("actions")
-    action_ex = action.add_mutually_exclusive_group()
-    action_ex.add_argument(
-        "-i",
-        dest="info",
-        action="count",
-        help=textwrap.dedent(
-            """\
-            Output workout information.
-                -i  : Workout, lap and track info
-                -ii : Workout, lap, track and trackpoint info
-            """
-        ),
-    )
-    action_ex.add_argument(
-        "-m",
-        dest="merge",
-        type=str,
-        choices=["append_laps", "merge_lap", "merge_track"],
-        action="store",
-        help=textwrap.dedent(
-            """\
-            Merge multiple workouts into one workout.
-            Options:
-                append_laps  - Append all laps from all workouts into one workout 
-                merge_laps   - Merge all laps from all workouts into one lap
-                merge_tracks - Merge all tracks from all workouts into one lap with one track
-            Example:
-                ./tcx.py -m merge_lap -o out.tcx f1.tcx f2.tcx f3.tcx 
-            """
-        ),
-    )
-    action_ex.add_argument(
-        "-s",
-        dest="scale_factor",
-        nargs="?",
-        type=float,
-        help="Scale duration, power, cadence and distance by the specified factor",
-    )
+        return trackpoint_info
 
-    # --------------------
-    # -- Other arguments
 
-    parser.add_argument(
-        "-o", dest="output_file", nargs="?", help="Output TCX file",
-    )
+class Columns:
+    """
+    Column-oriented representation of a sequence of trackpoints.
 
-    parser.add_argument("input", type=str, nargs="+", help="Input TCX files")
+    Each trackpoint is parsed exactly once and every field is kept
+    in a compact typed array of doubles accompanied by a mask
+    of present values. Missing values are stored as zeros.
+    Time is stored as the number of seconds since the epoch (UTC).
 
-    return parser.parse_args()
+    Optionally the columns keep references to the XML nodes
+    the values were parsed from, so the updated values
+    could be written back to the workout tree.
+    """
 
+    TIME = "time"
+    DISTANCE = "distance"
+    HEART_RATE = "heart_rate"
+    CADENCE = "cadence"
+    WATTS = "watts"
+    LATITUDE = "latitude"
+    LONGITUDE = "longitude"
+    ALTITUDE = "altitude"
+
+    FIELDS = (TIME, DISTANCE, HEART_RATE, CADENCE, WATTS, LATITUDE, LONGITUDE, ALTITUDE)
+
+    __Tags = {
+        "Time": TIME,
+        "DistanceMeters": DISTANCE,
+        "Cadence": CADENCE,
+        "AltitudeMeters": ALTITUDE,
+    }
+    __HeartRate = "HeartRateBpm"
+    __Position = "Position"
+    __Coordinates = {"LatitudeDegrees": LATITUDE, "LongitudeDegrees": LONGITUDE}
+    __Extensions = "Extensions"
+    __Header = struct.Struct("<IBB")
 
-def handle_action(args):
+    def __init__(self, nodes=False):
+        self._values = {field: array("d") for field in Columns.FIELDS}
+        self._masks = {field: bytearray() for field in Columns.FIELDS}
+        self._nodes = {field: [] for field in Columns.FIELDS} if nodes else None
+
+    def __len__(self):
+        return len(self._masks[Columns.TIME])
+
+    @classmethod
+    def from_trackpoints(cls, trackpoints, nodes=False):
+        """
+        Parses trackpoint elements into the columns.
+        """
+        columns = cls(nodes=nodes)
+        for trackpoint in trackpoints:
+            columns.append(trackpoint)
+        return columns
+
+    def append(self, trackpoint: ET._Element):
+        """
+        Parses a single trackpoint element and appends its values.
+        Values are looked up only at their places in the TCX schema,
+        e.g. "DistanceMeters" of the nested extensions is ignored.
+        """
+        found = {}
+        for child in trackpoint:
+            tag = child.tag
+            if not isinstance(tag, str):
+                continue
+
+            name = TCX.local_name(tag)
+            field = Columns.__Tags.get(name)
+            if field is not None:
+                found.setdefault(field, child)
+            elif name == Columns.__HeartRate:
+                if len(child):
+                    found.setdefault(Columns.HEART_RATE, child[0])
+            elif name == Columns.__Position:
+                for coordinate in child:
+                    field = Columns.__Coordinates.get(TCX.local_name(coordinate.tag))
+                    if field is not None:
+                        found.setdefault(field, coordinate)
+            elif name == Columns.__Extensions:
+                watts = Trackpoint.find_watts(child)
+                if watts is not None:
+                    found.setdefault(Columns.WATTS, watts)
+
+        for field in Columns.FIELDS:
+            node = found.get(field)
+            present = node is not None and node.text is not None
+            self._values[field].append(
+                Columns.__parse(field, node.text) if present else 0.0
+            )
+            self._masks[field].append(present)
+            if self._nodes is not None:
+                self._nodes[field].append(node if present else None)
+
+    def extend(self, columns):
+        """
+        Appends all the values of the other columns.
+        """
+        for field in Columns.FIELDS:
+            self._values[field].extend(columns._values[field])
+            self._masks[field].extend(columns._masks[field])
+            if self._nodes is not None:
+                self._nodes[field].extend(
+                    columns._nodes[field]
+                    if columns._nodes is not None
+                    else [None] * len(columns)
+                )
+
+    def values(self, field):
+        """
+        Typed array with all the values of the field.
+        """
+        return self._values[field]
+
+    def mask(self, field):
+        """
+        Mask of the present values of the field.
+        """
+        return self._masks[field]
+
+    def present(self, field):
+        """
+        Iterates over present values of the field.
+        """
+        return compress(self._values[field], self._masks[field])
+
+    def get(self, field, i):
+        """
+        Value of the field of the i-th trackpoint or None if it is missing.
+        """
+        return self._values[field][i] if self._masks[field][i] else None
+
+    def update(self, field, func):
+        """
+        Applies the function to all present values of the field.
+        New values are written back to the trackpoint nodes, if available.
+        """
+        values, mask = self._values[field], self._masks[field]
+        nodes = self._nodes[field] if self._nodes is not None else None
+
+        for i in compress(range(len(mask)), mask):
+            values[i] = func(values[i])
+            if nodes is not None:
+                nodes[i].text = Columns.__format(field, values[i])
+
+    @property
+    def start_time(self):
+        """
+        Time of the earliest trackpoint.
+        """
+        return TCX.from_epoch(min(self.present(Columns.TIME)))
+
+    @property
+    def finish_time(self):
+        """
+        Time of the latest trackpoint.
+        """
+        return TCX.from_epoch(max(self.present(Columns.TIME)))
+
+    def info(self, prefix="  ", stream=sys.__stdout__):
+        """
+        Outputs trackpoint info to a stream.
+        """
+        for i in range(len(self)):
+            trackpoint_info = Trackpoint.describe(
+                TCX.from_epoch(self._values[Columns.TIME][i]),
+                self.get(Columns.DISTANCE, i),
+                self.get(Columns.WATTS, i),
+                self.get(Columns.CADENCE, i),
+            )
+            print(prefix + trackpoint_info, file=stream)
+
+    def to_dict(self):
+        """
+        Fields with any present value as lists of the values,
+        None for the missing ones.
+        """
+        columns = {}
+        for field in Columns.FIELDS:
+            mask = self._masks[field]
+            if any(mask):
+                values = self._values[field]
+                columns[field] = [v if m else None for v, m in zip(values, mask)]
+        return columns
+
+    def to_bytes(self):
+        """
+        Compact binary representation of the columns.
+        Fields without any present value are omitted,
+        masks are stored only for partially present fields.
+        """
+        stored, masked, payload = 0, 0, []
+        for bit, field in enumerate(Columns.FIELDS):
+            mask = self._masks[field]
+            if not any(mask):
+                continue
+
+            values = self._values[field]
+            if sys.byteorder != "little":
+                values = array("d", values)
+                values.byteswap()
+
+            stored |= 1 << bit
+            payload.append(values.tobytes())
+            if not all(mask):
+                masked |= 1 << bit
+                payload.append(bytes(mask))
+
+        return Columns.__Header.pack(len(self), stored, masked) + b"".join(payload)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Restores the columns from the binary representation.
+        """
+        length, stored, masked = Columns.__Header.unpack_from(data)
+        data, offset = memoryview(data), Columns.__Header.size
+
+        columns = cls()
+        for bit, field in enumerate(Columns.FIELDS):
+            if not stored & (1 << bit):
+                columns._values[field] = array("d", [0.0]) * length
+                columns._masks[field] = bytearray(length)
+                continue
+
+            values = array("d")
+            values.frombytes(data[offset : offset + 8 * length])
+            if sys.byteorder != "little":
+                values.byteswap()
+            columns._values[field] = values
+            offset += 8 * length
+
+            if masked & (1 << bit):
+                columns._masks[field] = bytearray(data[offset : offset + length])
+                offset += length
+            else:
+                columns._masks[field] = bytearray(b"\x01" * length)
+
+        return columns
+
+    @staticmethod
+    def __parse(field, text):
+        if field == Columns.TIME:
+            return TCX.parse_epoch(text)
+        return float(text)
+
+    @staticmethod
+    def __format(field, value):
+        if field == Columns.TIME:
+            return TCX.to_tcx_time_string(TCX.from_epoch(value))
+        if field == Columns.CADENCE:
+            return str(round(value))
+        return str(float(value))
+
+
+class TrackSummary:
     """
+    Time boundaries and the number of trackpoints of a track.
+    Trackpoint columns are kept only when they are needed
+    for the verbose output.
     """
 
-    # Output info
-    if args.info is not None:
+    def __init__(self, start_time, finish_time, trackpoints, columns=None):
+        self.start_time = start_time
+        self.finish_time = finish_time
+        self.duration = TCX.span(start_time, finish_time)
+        self.trackpoints = trackpoints
+        self.columns = columns
 
-        if args.output_file is None:
-            handle_info(args.input, verbose=args.info > 1)
-        else:
-            print(f"Saving output to {args.output_file}... ", end="", flush=True)
-            with open(args.output_file, "w") as f:
-                handle_info(args.input, verbose=args.info > 1, stream=f)
-            print("Done")
+    @classmethod
+    def from_columns(cls, columns, keep_columns=True):
+        """
+        Summarizes track trackpoints given in form of columns.
+        """
+        if not len(columns):
+            return cls(None, None, 0, columns if keep_columns else None)
+
+        return cls(
+            columns.start_time,
+            columns.finish_time,
+            len(columns),
+            columns if keep_columns else None,
+        )
 
-    # Merge workouts
-    elif args.merge is not None:
-        output = args.output_file if args.output_file is not None else "out.tcx"
-        print(
-            f"Merging [{', '.join(args.input)}] into [{output}]... ", end="", flush=True
+    def info(self, prefix="  ", n=0, verbose=False, stream=sys.__stdout__):
+        """
+        Outputs track info to a stream.
+        """
+        track_title = "Track #{0:d} [{1} -> {2}]".format(
+            n, TCX.to_timeonly(self.start_time), TCX.to_timeonly(self.finish_time)
         )
-        handle_merge(args.input, output)
-        print("Done")
+        print(prefix + track_title, file=stream)
 
-    # Scale workouts
-    elif args.scale_factor is not None:
-        if len(args.input) > 1:
-            print(
-                f"Scaling of multiple workouts is not supported: [{', '.join(args.input)}]."
-                + " Please scale one workout at a time.\n",
-            )
-            return
+        prefix += "  "
+        print(prefix + "Start time:   " + TCX.to_ts(self.start_time), file=stream)
+        print(prefix + "Finish time:  " + TCX.to_ts(self.finish_time), file=stream)
+        print(prefix + "Duration:     " + str(TCX.chop_ms(self.duration)), file=stream)
+        print(prefix + "Trackpoints:  " + str(self.trackpoints), file=stream)
 
-        output = args.output_file if args.output_file is not None else "out.tcx"
-        print(
-            f"Scaling [{args.input[0]}] workout. Output: [{output}]... ",
-            end="",
-            flush=True,
+        if verbose and self.columns is not None:
+            self.columns.info(prefix + "  ", stream=stream)
+
+    def to_dict(self, verbose=False):
+        """
+        Track info as a dictionary of JSON types.
+        Trackpoint columns are added in verbose mode.
+        """
+        track = dict(
+            start_time=TCX.to_iso(self.start_time),
+            finish_time=TCX.to_iso(self.finish_time),
+            duration=TCX.to_seconds(self.duration),
+            trackpoints=self.trackpoints,
         )
-        handle_scale(args.input[0], float(args.scale_factor), output)
-        print("Done")
+        if verbose and self.columns is not None:
+            track["columns"] = self.columns.to_dict()
+        return track
 
 
-def handle_info(input, verbose=False, stream=sys.__stdout__):
-    for f in input:
-        try:
-            print(f"==== {f} =======================================", file=stream)
-            w = Workout.load(f)
-            w.info(verbose=verbose, stream=stream)
-        except Exception as e:
-            print(f"Failed to process {f} file. \n{e}\n\n", file=stream)
+class LapSummary:
+    """
+    Lap totals together with the summaries of the lap tracks.
+    """
 
+    def __init__(
+        self,
+        start_time,
+        distance,
+        calories,
+        cadence,
+        heart_rate,
+        max_heart_rate,
+        tracks,
+    ):
+        self.start_time = start_time
+        self.finish_time = max(
+            (t.finish_time for t in tracks if t.finish_time is not None), default=None
+        )
+        self.duration = TCX.span(start_time, self.finish_time)
+        self.distance = distance
+        self.calories = calories
+        self.cadence = cadence
+        self.heart_rate = heart_rate
+        self.max_heart_rate = max_heart_rate
+        self.tracks = tracks
 
-def handle_scale(input, factor, output):
-    w = Workout.load(input)
-    w.scale(factor)
-    w.save(output)
+    @classmethod
+    def from_lap(cls, lap, tracks):
+        """
+        Summarizes lap totals, given the summaries of the lap tracks.
+        """
+        return cls(
+            lap.start_time,
+            lap.distance,
+            lap.calories,
+            lap.cadence,
+            lap.heart_rate,
+            lap.max_heart_rate,
+            tracks,
+        )
+
+    def info(self, prefix="  ", n="", verbose=False, stream=sys.__stdout__):
+        """
+        Outputs lap info to a stream.
+        """
+        start_time, finish_time, duration = (
+            self.start_time,
+            self.finish_time,
+            self.duration,
+        )
+
+        lap_title = "Lap" if n == "" else "Lap #{0:d}".format(n)
+        lap_title += " [{0} -> {1}]".format(
+            TCX.to_timeonly(start_time), TCX.to_timeonly(finish_time)
+        )
 
+        print(prefix + lap_title, file=stream)
+        prefix += "  "
 
-def handle_merge(input, output):
-    w = Workout.merge_all(input)
-    w.save(output)
+        print(prefix + "Start time:   " + TCX.to_ts(start_time), file=stream)
+        print(prefix + "Finish time:  " + TCX.to_ts(finish_time), file=stream)
+        print(prefix + "Duration:     " + str(TCX.chop_ms(duration)), file=stream)
+        print(prefix + "Distance:     " + f"{self.distance:,}m", file=stream)
+        print(prefix + "Calories:     " + str(self.calories), file=stream)
+        print(prefix + "Avg cadence:  " + str(self.cadence), file=stream)
+
+        if self.heart_rate:
+            print(
+                prefix + "Avg HR:       " + str(self.heart_rate) + " bpm", file=stream
+            )
+
+        if self.max_heart_rate:
+            print(
+                prefix + "Max HR:       " + str(self.max_heart_rate) + " bpm",
+                file=stream,
+            )
+
+        print(prefix + "Tracks:", file=stream)
+        for tn, track in enumerate(self.tracks):
+            track.info(prefix=prefix + "  ", n=tn, verbose=verbose, stream=stream)
+
+        print("", file=stream)
+
+    def to_dict(self, verbose=False):
+        """
+        Lap info as a dictionary of JSON types, tracks included.
+        """
+        tracks = [track.to_dict(verbose) for track in self.tracks]
+        return dict(
+            start_time=TCX.to_iso(self.start_time),
+            finish_time=TCX.to_iso(self.finish_time),
+            duration=TCX.to_seconds(self.duration),
+            distance=self.distance,
+            calories=self.calories,
+            cadence=self.cadence,
+            heart_rate=self.heart_rate,
+            max_heart_rate=self.max_heart_rate,
+            trackpoints=TCX.total(track["trackpoints"] for track in tracks),
+            tracks=tracks,
+        )
+
+
+class WorkoutSummary:
+    """
+    Workout identity together with the summaries of the workout laps.
+    """
+
+    def __init__(self, workout_id, activity, laps):
+        self.workout_id = workout_id
+        self.activity = activity
+        self.laps = laps
+        self.start_time = min((lap.start_time for lap in laps), default=None)
+        self.finish_time = max(
+            (lap.finish_time for lap in laps if lap.finish_time is not None),
+            default=None,
+        )
+        self.duration = TCX.span(self.start_time, self.finish_time)
+
+    def info(self, prefix="", verbose=False, stream=sys.__stdout__):
+        """
+        Outputs workout info to a stream.
+        """
+        print(prefix + "Workout:", file=stream)
+        prefix += "  "
+
+        start_time, finish_time, duration = (
+            self.start_time,
+            self.finish_time,
+            self.duration,
+        )
+
+        print(prefix + "Id:           " + self.workout_id, file=stream)
+        print(prefix + "Activity:     " + self.activity, file=stream)
+        print(prefix + "Start time:   " + TCX.to_ts(start_time), file=stream)
+        print(prefix + "Finish time:  " + TCX.to_ts(finish_time), file=stream)
+        print(prefix + "Duration:     " + str(TCX.chop_ms(duration)), file=stream)
+
+        print(prefix + "Laps:         ", file=stream)
+        for n, lap in enumerate(self.laps):
+            lap.info(prefix=prefix + "  ", n=n, verbose=verbose, stream=stream)
+
+        print("", file=stream)
+        print("", file=stream)
+
+    def to_dict(self, verbose=False):
+        """
+        Workout info as a dictionary of JSON types, laps and tracks included.
+        Times are ISO 8601 strings (UTC), durations are in seconds.
+        Heart rate and cadence of the workout are the averages of the laps
+        weighted by their durations. Trackpoints are None if they were
+        not counted, as in the header-only summaries.
+        """
+        laps = [lap.to_dict(verbose) for lap in self.laps]
+        return dict(
+            workout_id=self.workout_id,
+            activity=self.activity,
+            start_time=TCX.to_iso(self.start_time),
+            finish_time=TCX.to_iso(self.finish_time),
+            duration=TCX.to_seconds(self.duration),
+            distance=sum(lap["distance"] or 0.0 for lap in laps),
+            calories=sum(lap["calories"] or 0 for lap in laps),
+            heart_rate=WorkoutSummary.__average(laps, "heart_rate"),
+            max_heart_rate=max(
+                (lap["max_heart_rate"] for lap in laps if lap["max_heart_rate"]),
+                default=None,
+            ),
+            cadence=WorkoutSummary.__average(laps, "cadence"),
+            trackpoints=TCX.total(lap["trackpoints"] for lap in laps),
+            laps=laps,
+        )
+
+    @staticmethod
+    def __average(laps, field):
+        # Average of the lap values weighted by the lap durations
+        laps = [lap for lap in laps if lap[field] and lap["duration"]]
+        total = sum(lap["duration"] for lap in laps)
+        if not total:
+            return None
+        return sum(lap[field] * lap["duration"] for lap in laps) / total
+
+
+class WorkoutAnalysis:
+    """
+    Power, cadence and heart rate analytics of the workout.
+
+    Trackpoints of all the laps and tracks are aligned to a 1 Hz series,
+    where each second takes the value of the latest sample at or before it,
+    and the seconds further than MAX_GAP from the latest sample are zeros.
+    Rolling averages are computed from the cumulative sums of the series,
+    so all the work is done by the builtins iterating in C.
+
+    Zeros are counted as is only for power: no power is recorded
+    while coasting or paused, and NP, IF and TSS are defined over
+    the whole ride. Averages of heart rate and cadence are taken over
+    the seconds that have a sample, and their best efforts only over
+    the windows without gaps.
+    """
+
+    WINDOWS = (5, 60, 300, 1200)
+    MAX_GAP = 10
+    NP_WINDOW = 30
+
+    def __init__(self, duration, power, cadence, heart_rate, ftp=None):
+        self.duration = duration
+        self.power = power
+        self.cadence = cadence
+        self.heart_rate = heart_rate
+        self.ftp = ftp
+
+        self.normalized_power = None
+        self.variability_index = None
+        self.intensity_factor = None
+        self.tss = None
+
+        if power is not None:
+            self.normalized_power = WorkoutAnalysis.normalized(power["sums"])
+        if self.normalized_power is not None and power["average"]:
+            self.variability_index = self.normalized_power / power["average"]
+        if self.normalized_power is not None and ftp:
+            self.intensity_factor = self.normalized_power / ftp
+            self.tss = (
+                duration.total_seconds()
+                * self.normalized_power
+                * self.intensity_factor
+                / (ftp * 3600)
+                * 100
+            )
+
+    @classmethod
+    def from_summary(cls, summary, ftp=None, windows=WINDOWS):
+        """
+        Analyzes the trackpoint columns of the workout summary.
+        """
+        tracks = [track.columns for lap in summary.laps for track in lap.tracks]
+        if any(columns is None for columns in tracks):
+            raise ValueError("Trackpoint columns are required for the analysis")
+
+        def samples(field):
+            times, values = array("d"), array("d")
+            for columns in tracks:
+                times.extend(
+                    compress(columns.values(Columns.TIME), columns.mask(field))
+                )
+                values.extend(columns.present(field))
+            return times, values
+
+        times, _ = samples(Columns.TIME)
+        if not times:
+            return cls(timedelta(0), None, None, None, ftp)
+
+        start = min(times)
+        length = int(max(times) - start) + 1
+
+        def analyze(field, gaps=False):
+            times, values = samples(field)
+            if not values:
+                return None
+
+            series, present = WorkoutAnalysis.align(times, values, start, length)
+            sums = WorkoutAnalysis.cumulative(series)
+            if gaps:
+                count, covered = length, None
+            else:
+                covered = WorkoutAnalysis.cumulative(present)
+                count = int(covered[-1])
+            return dict(
+                series=series,
+                present=present,
+                sums=sums,
+                average=sums[-1] / count,
+                max=max(values),
+                best={w: WorkoutAnalysis.best(sums, w, covered) for w in windows},
+            )
+
+        return cls(
+            summary.duration or timedelta(0),
+            analyze(Columns.WATTS, gaps=True),
+            analyze(Columns.CADENCE),
+            analyze(Columns.HEART_RATE),
+            ftp,
+        )
+
+    @staticmethod
+    def align(times, values, start, length, max_gap=MAX_GAP):
+        """
+        Aligns the samples to the 1 Hz series of the given length.
+        Returns the series and the presence mask of the same length,
+        which is 1.0 for the seconds with a recorded or held sample
+        and 0.0 for the zeros filled in after the gaps.
+
+        Samples recorded every second form runs that are copied
+        into the series at once, only the gaps between the runs
+        are filled one by one.
+        """
+        if any(map(gt, times, times[1:])):
+            pairs = sorted(zip(times, values))
+            times, values = array("d", (t for t, _ in pairs)), [v for _, v in pairs]
+        values = array("d", values)
+
+        offsets = array("l", map(int, map(sub, times, repeat(start))))
+        count = len(offsets)
+        steps = map(sub, offsets[1:], offsets[:-1])
+        breaks = list(compress(range(1, count), map(ne, steps, repeat(1))))
+
+        series = array("d", [0.0]) * length
+        present = array("d", [0.0]) * length
+        for first, last in zip([0] + breaks, breaks + [count]):
+            offset = offsets[first]
+            end = offset + last - first
+            series[offset:end] = values[first:last]
+
+            # Hold the latest value until the next sample, but not longer than the gap
+            hold = min(offsets[last] if last < count else length, end + max_gap)
+            if hold > end:
+                series[end:hold] = array("d", [values[last - 1]]) * (hold - end)
+            end = max(hold, end)
+            present[offset:end] = array("d", [1.0]) * (end - offset)
+
+        return series, present
+
+    @staticmethod
+    def cumulative(series):
+        """
+        Cumulative sums of the series, starting with zero.
+        """
+        return array("d", accumulate(series, initial=0.0))
+
+    @staticmethod
+    def rolling_sums(sums, window):
+        """
+        Sums of all the windows of the series, given its cumulative sums.
+        """
+        return map(sub, sums[window:], sums[:-window])
+
+    @staticmethod
+    def best(sums, window, covered=None):
+        """
+        Best average over the window of the series, given its cumulative sums.
+        Given the cumulative sums of the presence mask, only the windows
+        without gaps are considered.
+        None if the series is shorter than the window or no window qualifies.
+        """
+        if len(sums) - 1 < window:
+            return None
+        rolling = WorkoutAnalysis.rolling_sums(sums, window)
+        if covered is not None:
+            full = WorkoutAnalysis.rolling_sums(covered, window)
+            rolling = compress(rolling, map(eq, full, repeat(window)))
+        best = max(rolling, default=None)
+        return best / window if best is not None else None
+
+    @staticmethod
+    def normalized(sums, window=NP_WINDOW):
+        """
+        Normalized power: the fourth root of the mean of the fourth powers
+        of the rolling averages over the window, given cumulative sums of the power.
+        """
+        count = len(sums) - window
+        if count < 1:
+            return None
+        rolling = WorkoutAnalysis.rolling_sums(sums, window)
+        return (sum(map(pow, rolling, repeat(4))) / count) ** 0.25 / window
+
+    def info(self, prefix="", stream=sys.__stdout__):
+        """
+        Outputs the analysis to a stream.
+        """
+        print(prefix + "Analysis:", file=stream)
+        prefix += "  "
+
+        print(prefix + "Duration:     " + str(TCX.chop_ms(self.duration)), file=stream)
+        self.__info_field(prefix, "power", self.power, "W", stream)
+
+        if self.normalized_power is not None:
+            print(prefix + f"NP:           {self.normalized_power:.0f}W", file=stream)
+        if self.variability_index is not None:
+            print(prefix + f"VI:           {self.variability_index:.2f}", file=stream)
+        if self.intensity_factor is not None:
+            print(prefix + f"FTP:          {self.ftp:.0f}W", file=stream)
+            print(prefix + f"IF:           {self.intensity_factor:.2f}", file=stream)
+            print(prefix + f"TSS:          {self.tss:.0f}", file=stream)
+
+        self.__info_field(prefix, "cadence", self.cadence, "", stream)
+        self.__info_field(prefix, "HR", self.heart_rate, " bpm", stream)
+
+        print("", file=stream)
+        print("", file=stream)
+
+    @staticmethod
+    def __info_field(prefix, name, field, unit, stream):
+        if field is None:
+            return
+
+        best = "; ".join(
+            f"{WorkoutAnalysis.__window(w)}: {value:.0f}{unit}"
+            for w, value in field["best"].items()
+            if value is not None
+        )
+        average, maximum = field["average"], field["max"]
+        print(prefix + f"Avg {name}:".ljust(14) + f"{average:.0f}{unit}", file=stream)
+        print(prefix + f"Max {name}:".ljust(14) + f"{maximum:.0f}{unit}", file=stream)
+        print(prefix + f"Best {name}:".ljust(14) + (best or "-"), file=stream)
+
+    @staticmethod
+    def __window(seconds):
+        if seconds % 60:
+            return f"{seconds}s"
+        return f"{seconds // 60}m"
+
+
+class WorkoutStream:
+    """
+    Streaming reader of TCX files.
+
+    The file is walked with 'iterparse' and the workout elements
+    are yielded as soon as they are parsed. Trackpoints, tracks and laps
+    are removed from the tree right after they have been processed,
+    so the memory stays flat no matter how big the file is.
+
+    The stream yields (event, name, element) tuples:
+        - ("start", name, element) and ("end", name, element)
+          for the structural elements of the workout
+          (TrainingCenterDatabase, Activities, Activity, Lap, Track);
+        - ("end", name, element) for every other complete element
+          whose parent is a structural element (e.g. Id, lap totals,
+          Trackpoint, Creator, Author).
+    """
+
+    __Containers = {"TrainingCenterDatabase", "Activities", "Activity", "Lap", "Track"}
+    __Disposable = {"Activity", "Lap", "Track", "Trackpoint"}
+    __Counters = {"Lap": "laps", "Trackpoint": "trackpoints"}
+
+    def __init__(self, file):
+        self._file = file
+
+    def __iter__(self):
+        with open_input(self._file) as source:
+            yield from self.__events(source)
+
+    def __events(self, source):
+        # Structural elements always form a chain from the root,
+        # so an element is a child of the innermost structural element
+        # whenever it is exactly one level deeper.
+        containers, depth = [], 0
+
+        profiler = Profiler.current
+        counters = WorkoutStream.__Counters if profiler.enabled else {}
+        events = profiler.iterate(
+            ET.iterparse(source, events=("start", "end")), "parse"
+        )
+
+        for event, elem in events:
+            if event == "start":
+                depth += 1
+                if depth == len(containers) + 1:
+                    name = TCX.local_name(elem.tag)
+                    if name in WorkoutStream.__Containers:
+                        containers.append(elem)
+                        yield event, name, elem
+                continue
+
+            depth -= 1
+            if depth == len(containers) - 1:
+                containers.pop()
+            elif depth != len(containers):
+                continue
+
+            name = TCX.local_name(elem.tag)
+            yield event, name, elem
+
+            if name in WorkoutStream.__Disposable:
+                if name in counters:
+                    profiler.count(counters[name])
+
+                # Elements detached by the consumer are left to it
+                parent = elem.getparent()
+                if parent is not None:
+                    elem.clear()
+                    parent.remove(elem)
+
+    def summary(self, verbose=False):
+        """
+        Summarizes the workout in one pass over the file.
+        Trackpoint columns are collected only in verbose mode.
+        """
+        workout_id, activity, laps, tracks = None, None, [], []
+        columns, start, finish, count = None, None, None, 0
+
+        with Profiler.current.phase("compute"):
+            for event, name, elem in self:
+                if event == "start":
+                    if name == "Activity" and activity is None:
+                        activity = elem.get("Sport")
+                    elif name == "Lap":
+                        tracks = []
+                    elif name == "Track":
+                        columns = Columns() if verbose else None
+                        start, finish, count = None, None, 0
+
+                elif name == "Id" and workout_id is None:
+                    workout_id = elem.text
+
+                elif name == "Trackpoint":
+                    time = Trackpoint(elem).time
+                    start = time if start is None else min(start, time)
+                    finish = time if finish is None else max(finish, time)
+                    count += 1
+                    if columns is not None:
+                        columns.append(elem)
+
+                elif name == "Track":
+                    tracks.append(TrackSummary(start, finish, count, columns))
+
+                elif name == "Lap":
+                    laps.append(LapSummary.from_lap(Lap(elem), tracks))
+
+        return WorkoutSummary(workout_id, activity, laps)
+
+    def save(self, file, transform=None, resampler=None):
+        """
+        Streams the workout to the TCX file, applying the transform
+        (see Transform) to the elements on the way.
+        Trackpoints of each track are passed through the resampler, if given.
+
+        Laps are transformed once their totals are read, i.e. before
+        the first track of the lap. The totals are held back until then,
+        trackpoints of the lap are not available to the transform.
+        """
+        profiler = Profiler.current
+        if transform is not None:
+            transform_trackpoint = profiler.wrap(transform.trackpoint, "compute")
+            transform_lap = profiler.wrap(transform.lap, "compute")
+            transform_element = profiler.wrap(transform.element, "compute")
+
+        with open_output(file) as f, profiler.phase("serialize"):
+            writer = TCXWriter(f)
+            writer.declaration()
+
+            # Lap that is held back until its totals are transformed
+            lap = None
+
+            for event, name, elem in self:
+                if name in WorkoutStream.__Containers:
+                    if event == "start" and name == "Lap" and transform is not None:
+                        lap = elem
+                        continue
+
+                    if lap is not None:
+                        transform_lap(Lap(lap))
+                        writer.start(lap)
+                        for total in lap:
+                            if total is elem:
+                                break
+                            writer.write(total)
+                        lap = None
+
+                    if event == "start":
+                        writer.start(elem)
+                    else:
+                        if name == "Track" and resampler is not None:
+                            for trackpoint in resampler.flush():
+                                writer.write(trackpoint)
+                        writer.end(elem)
+                    continue
+
+                if lap is not None:
+                    continue
+
+                if name == "Trackpoint":
+                    if transform is not None:
+                        transform_trackpoint(Trackpoint(elem))
+                    if resampler is not None:
+                        for trackpoint in resampler.feed(elem):
+                            writer.write(trackpoint)
+                        continue
+                elif transform is not None:
+                    elem = transform_element(name, elem)
+                    if elem is None:
+                        continue
+                writer.write(elem)
+
+
+class Transform:
+    """
+    Streaming transform of the workout, applied by WorkoutStream.save
+    to the elements while they flow from the input to the output.
+    Elements are modified in place, transforms are composed with Pipeline.
+    """
+
+    def trackpoint(self, trackpoint):
+        """
+        Transforms the trackpoint.
+        """
+
+    def lap(self, lap):
+        """
+        Transforms the lap totals, before the tracks of the lap.
+        """
+
+    def element(self, name, elem):
+        """
+        Transforms any other element (e.g. Id, Creator).
+        Returns the element to write or None to drop it.
+        """
+        return elem
+
+
+class Pipeline(Transform):
+    """
+    Transforms applied one after another.
+    """
+
+    def __init__(self, transforms):
+        self.transforms = list(transforms)
+
+    def trackpoint(self, trackpoint):
+        for transform in self.transforms:
+            transform.trackpoint(trackpoint)
+
+    def lap(self, lap):
+        for transform in self.transforms:
+            transform.lap(lap)
+
+    def element(self, name, elem):
+        for transform in self.transforms:
+            elem = transform.element(name, elem)
+            if elem is None:
+                break
+        return elem
+
+
+class Scale(Transform):
+    """
+    Scales distance, cadence and watts of the trackpoints
+    and the lap totals (see Trackpoint.scale and Lap.scale).
+    """
+
+    def __init__(self, factor, distance=True, cadence=True, watts=True):
+        self.factor = factor
+        self.distance = distance
+        self.cadence = cadence
+        self.watts = watts
+
+    def trackpoint(self, trackpoint):
+        trackpoint.scale(self.factor, self.distance, self.cadence, self.watts)
+
+    def lap(self, lap):
+        lap.scale(self.factor, distance=self.distance, cadence=self.cadence)
+
+
+class Shift(Transform):
+    """
+    Shifts the workout in time by the number of seconds:
+    trackpoint times, lap start times and the Id, if it is a time.
+    """
+
+    __Id = "Id"
+
+    def __init__(self, seconds):
+        self.delta = timedelta(seconds=seconds)
+
+    def trackpoint(self, trackpoint):
+        trackpoint.time = trackpoint.time + self.delta
+
+    def lap(self, lap):
+        lap.start_time = lap.start_time + self.delta
+
+    def element(self, name, elem):
+        if name == Shift.__Id and elem.text:
+            try:
+                time = TCX.parse_time(elem.text)
+            except ValueError:
+                return elem
+            elem.text = TCX.to_tcx_time_string(time + self.delta)
+        return elem
+
+
+class Strip(Transform):
+    """
+    Removes the fields from the trackpoints and the laps:
+        hr         - heart rate of the trackpoints and the laps
+        position   - latitude and longitude
+        altitude   - altitude
+        cadence    - cadence of the trackpoints and the laps
+        watts      - watts of the activity extension
+        extensions - all the extensions of the trackpoints, laps and activities
+    """
+
+    FIELDS = ("hr", "position", "altitude", "cadence", "watts", "extensions")
+
+    __Trackpoint = {
+        "hr": ("HeartRateBpm",),
+        "position": ("Position",),
+        "altitude": ("AltitudeMeters",),
+        "cadence": ("Cadence",),
+        "extensions": ("Extensions",),
+    }
+    __Lap = {
+        "hr": ("AverageHeartRateBpm", "MaximumHeartRateBpm"),
+        "cadence": ("Cadence",),
+        "extensions": ("Extensions",),
+    }
+    __Extensions = "Extensions"
+
+    def __init__(self, fields):
+        unknown = set(fields) - set(Strip.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+        self.fields = set(fields)
+        self.watts = "watts" in self.fields and "extensions" not in self.fields
+        self.__trackpoint = [
+            name for field in self.fields for name in Strip.__Trackpoint.get(field, ())
+        ]
+        self.__lap = [
+            name for field in self.fields for name in Strip.__Lap.get(field, ())
+        ]
+
+    def trackpoint(self, trackpoint):
+        Strip.__remove(trackpoint, self.__trackpoint)
+        if self.watts:
+            watts = trackpoint._watts_node()
+            if watts is not None:
+                Strip.__detach(watts)
+                trackpoint.invalidate()
+
+    def lap(self, lap):
+        Strip.__remove(lap, self.__lap)
+
+    def element(self, name, elem):
+        if name == Strip.__Extensions and "extensions" in self.fields:
+            return None
+        return elem
+
+    @staticmethod
+    def __remove(element, names):
+        nodes = [node for name in names for node in element.children(name)]
+        for node in nodes:
+            Strip.__detach(node)
+        if nodes:
+            element.invalidate()
+
+    @staticmethod
+    def __detach(node):
+        # Keeps the indentation of the siblings by passing the tail over
+        parent, previous = node.getparent(), node.getprevious()
+        if previous is not None:
+            previous.tail = node.tail
+        else:
+            parent.text = node.tail
+        parent.remove(node)
+
+
+class Distance(Transform):
+    """
+    Sets the distances of the trackpoints and the lap totals
+    computed in advance for the whole workout (see WorkoutDistance).
+    Trackpoints and laps are expected in the order of the workout.
+    """
+
+    def __init__(self, distances, laps):
+        self.__distances = iter(distances)
+        self.__laps = iter(laps)
+
+    def trackpoint(self, trackpoint):
+        trackpoint.distance = round(next(self.__distances), 2)
+
+    def lap(self, lap):
+        next(self.__laps).apply(lap)
+
+
+class TimeResampler:
+    """
+    Resampler of the trackpoints into fixed time buckets.
+
+    Buckets are counted from the first trackpoint of each track.
+    The first trackpoint of a bucket represents it, with heart rate,
+    cadence and watts replaced by their averages over the bucket.
+    The last trackpoint of the track is always kept as is, so the time
+    and distance of the track, and the lap totals, stay consistent.
+    """
+
+    __Fields = ("heart_rate", "cadence", "watts")
+
+    def __init__(self, interval):
+        if interval <= 0:
+            raise ValueError(f"Resampling interval must be positive: {interval}")
+        self.interval = interval
+        self.__start = None
+        self.__reset(None)
+
+    def feed(self, elem):
+        """
+        Consumes the trackpoint element and returns the list of elements
+        that are complete and could be written.
+        """
+        # Detached trackpoints are not disposed of by the stream
+        elem.getparent().remove(elem)
+        trackpoint = Trackpoint(elem)
+        time = TCX.to_epoch(trackpoint.time)
+        if self.__start is None:
+            self.__start = time
+        bucket = int((time - self.__start) // self.interval)
+
+        resampled = []
+        if bucket != self.__bucket:
+            resampled.extend(self.__emit())
+            self.__reset(bucket, trackpoint)
+        else:
+            self.__last = trackpoint
+
+        for field in TimeResampler.__Fields:
+            value = getattr(trackpoint, field)
+            if value is not None:
+                self.__sums[field] += value
+                self.__counts[field] += 1
+        return resampled
+
+    def flush(self):
+        """
+        Returns the remaining elements of the track.
+        """
+        resampled = self.__emit() + (
+            [self.__last._element] if self.__last is not None else []
+        )
+        self.__start = None
+        self.__reset(None)
+        return resampled
+
+    def __reset(self, bucket, trackpoint=None):
+        self.__bucket = bucket
+        self.__first, self.__last = trackpoint, None
+        self.__sums = dict.fromkeys(TimeResampler.__Fields, 0.0)
+        self.__counts = dict.fromkeys(TimeResampler.__Fields, 0)
+
+    def __emit(self):
+        trackpoint = self.__first
+        if trackpoint is None:
+            return []
+
+        for field in TimeResampler.__Fields:
+            if self.__counts[field] and getattr(trackpoint, field) is not None:
+                average = self.__sums[field] / self.__counts[field]
+                setattr(trackpoint, field, round(average))
+        return [trackpoint._element]
+
+
+class PathResampler(ABC):
+    """
+    Base class of the resamplers that simplify the path of each track.
+
+    Trackpoints of a track are buffered until the end of the track,
+    so the memory is bounded by the size of the biggest track.
+    Positions are projected to meters with the equirectangular
+    projection, that is precise enough at the scale of a workout.
+    The first and the last trackpoints of the track, as well as
+    the trackpoints without position, are always kept.
+    """
+
+    EARTH_RADIUS = 6371008.8
+
+    def __init__(self, tolerance):
+        if tolerance < 0:
+            raise ValueError(f"Resampling tolerance must not be negative: {tolerance}")
+        self.tolerance = tolerance
+        self.__buffer = []
+
+    def feed(self, elem):
+        """
+        Consumes the trackpoint element and returns the list of elements
+        that are complete and could be written.
+        """
+        elem.getparent().remove(elem)
+        self.__buffer.append(elem)
+        return []
+
+    def flush(self):
+        """
+        Returns the simplified trackpoints of the track.
+        """
+        buffer, self.__buffer = self.__buffer, []
+
+        indexes, points = [], []
+        for n, elem in enumerate(buffer):
+            position = Trackpoint(elem).position
+            if position is not None:
+                indexes.append(n)
+                points.append(position)
+
+        keep = [True] * len(buffer)
+        if len(points) > 2:
+            scale = math.radians(1) * PathResampler.EARTH_RADIUS
+            ratio = math.cos(math.radians(points[0][0]))
+            points = [(lon * scale * ratio, lat * scale) for lat, lon in points]
+            for n, kept in zip(indexes, self.simplify(points)):
+                keep[n] = kept
+            keep[0] = keep[-1] = True
+
+        return list(compress(buffer, keep))
+
+    @abstractmethod
+    def simplify(self, points):
+        """
+        Returns the list of flags whether each of the (x, y) points is kept.
+        """
+
+
+class DouglasPeucker(PathResampler):
+    """
+    Douglas-Peucker simplification of the path.
+    Keeps the points that deviate from the simplified path
+    by more than the tolerance (meters).
+    """
+
+    def simplify(self, points):
+        keep = [False] * len(points)
+        keep[0] = keep[-1] = True
+
+        # Iterative to not hit the recursion limit on long tracks
+        stack = [(0, len(points) - 1)]
+        while stack:
+            first, last = stack.pop()
+            farthest, distance = None, self.tolerance
+            for n in range(first + 1, last):
+                d = DouglasPeucker.distance(points[n], points[first], points[last])
+                if d > distance:
+                    farthest, distance = n, d
+
+            if farthest is not None:
+                keep[farthest] = True
+                stack.append((first, farthest))
+                stack.append((farthest, last))
+
+        return keep
+
+    @staticmethod
+    def distance(point, start, end):
+        """
+        Distance from the point to the segment.
+        """
+        (x, y), (x1, y1), (x2, y2) = point, start, end
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = ((x - x1) * dx + (y - y1) * dy) / length if length else 0.0
+        t = min(1.0, max(0.0, t))
+        return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+class Visvalingam(PathResampler):
+    """
+    Visvalingam-Whyatt simplification of the path.
+    Removes the points with the smallest effective area one by one,
+    until all the remaining triangles are at least the square
+    of the tolerance (meters) large.
+    """
+
+    def simplify(self, points):
+        count = len(points)
+        previous, following = list(range(-1, count - 1)), list(range(1, count + 1))
+        areas = [math.inf] * count
+        for n in range(1, count - 1):
+            areas[n] = Visvalingam.area(points[n - 1], points[n], points[n + 1])
+
+        # Heap with lazy deletion: outdated areas are skipped when popped
+        heap = [(areas[n], n) for n in range(1, count - 1)]
+        heapq.heapify(heap)
+
+        keep, threshold = [True] * count, self.tolerance ** 2
+        while heap:
+            area, n = heapq.heappop(heap)
+            if not keep[n] or area != areas[n]:
+                continue
+            if area >= threshold:
+                break
+
+            keep[n] = False
+            p, f = previous[n], following[n]
+            following[p], previous[f] = f, p
+            for m in (p, f):
+                if 0 < m < count - 1:
+                    areas[m] = Visvalingam.area(
+                        points[previous[m]], points[m], points[following[m]]
+                    )
+                    heapq.heappush(heap, (areas[m], m))
+
+        return keep
+
+    @staticmethod
+    def area(a, b, c):
+        """
+        Area of the triangle.
+        """
+        return abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])) / 2
+
+
+class LapStats:
+    """
+    Running statistics of the trackpoints of a lap or a part of it,
+    used to rebuild the lap totals while streaming.
+
+    The previous (time, distance) is of the trackpoint preceding the part
+    in the same lap, so the time and distance between the parts are kept.
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous
+        self.start_time, self.finish_time = None, None
+        self.finish_distance = None
+        self.trackpoints = 0
+        self.total_seconds, self.distance, self.calories = None, None, None
+        self.max_heart_rate, self.max_speed = None, None
+        self.__heart_rate, self.__heart_rates = 0.0, 0
+        self.__cadence, self.__cadences = 0.0, 0
+        self.__last = None
+
+    def add(self, time, distance=None, heart_rate=None, cadence=None):
+        """
+        Accounts the values of the next trackpoint.
+        """
+        self.trackpoints += 1
+        if self.start_time is None:
+            self.start_time = time
+        self.finish_time = time
+
+        if distance is not None:
+            last, self.__last = self.__last, (time, distance)
+            self.finish_distance = distance
+            if last is not None and time > last[0]:
+                speed = (distance - last[1]) / (time - last[0])
+                if self.max_speed is None or speed > self.max_speed:
+                    self.max_speed = speed
+
+        if heart_rate is not None:
+            self.__heart_rate += heart_rate
+            self.__heart_rates += 1
+            self.max_heart_rate = max(self.max_heart_rate or 0, heart_rate)
+
+        if cadence is not None:
+            self.__cadence += cadence
+            self.__cadences += 1
+
+    @property
+    def heart_rate(self):
+        """
+        Average heart rate or None.
+        """
+        return self.__heart_rate / self.__heart_rates if self.__heart_rates else None
+
+    @property
+    def cadence(self):
+        """
+        Average cadence or None.
+        """
+        return self.__cadence / self.__cadences if self.__cadences else None
+
+    @property
+    def elapsed(self):
+        """
+        Seconds since the previous trackpoint till the last one.
+        """
+        if self.previous is None or self.finish_time is None:
+            return None
+        return self.finish_time - self.previous[0]
+
+    @property
+    def covered(self):
+        """
+        Meters since the previous trackpoint till the last one.
+        """
+        if self.previous is None or self.finish_distance is None:
+            return None
+        return self.finish_distance - (self.previous[1] or 0.0)
+
+    def apply(self, lap):
+        """
+        Sets the totals, if they are computed, and the statistics of the lap.
+        Maximum speed is set only if the lap reports it.
+        """
+        if self.total_seconds is not None:
+            lap.total_seconds = self.total_seconds
+        if self.distance is not None:
+            lap.distance = round(self.distance, 2)
+        if self.calories is not None:
+            lap.calories = round(self.calories)
+
+        if self.heart_rate is not None:
+            lap.heart_rate = self.heart_rate
+            lap.max_heart_rate = self.max_heart_rate
+        if self.cadence is not None:
+            lap.cadence = self.cadence
+        if self.max_speed is not None and lap.max_speed is not None:
+            lap.max_speed = round(self.max_speed, 3)
+
+
+class WorkoutSplitter:
+    """
+    Streaming splitter of a workout into multiple workouts
+    at the given times (epoch seconds), distances (meters)
+    or before the given laps (every lap, if no laps are given).
+
+    The file is streamed twice. The first pass assigns trackpoints
+    to the parts and collects statistics of the pieces of the laps,
+    the second pass writes all the parts at once. Totals of the laps
+    that are split are shared between the pieces by the time and
+    distance each piece covers, so they add up to the original totals.
+    Every part gets a new Id (its start time) and trackpoint distances
+    counted from the start of the part.
+    """
+
+    TIME = "time"
+    DISTANCE = "distance"
+    LAP = "lap"
+    KINDS = (TIME, DISTANCE, LAP)
+
+    __Containers = {"TrainingCenterDatabase", "Activities", "Activity"}
+    __Id = "Id"
+
+    def __init__(self, file, by, marks=None):
+        if by not in WorkoutSplitter.KINDS:
+            raise ValueError(f"Unknown kind of split: {by}")
+        if by != WorkoutSplitter.LAP and not marks:
+            raise ValueError(f"Split by {by} requires at least one mark")
+
+        self._file = file
+        self.by = by
+        self.marks = sorted(marks) if marks else None
+
+    def split(self, output):
+        """
+        Splits the workout, writing the n-th part (from 1) into 'output(n)'.
+        Returns the list of written files.
+        """
+        with Profiler.current.phase("compute"):
+            pieces, bases = self.__plan()
+        return self.__write(output, pieces, bases)
+
+    def __parts(self):
+        """
+        Streams the workout events together with the index of the lap
+        and the part they belong to. Parts never decrease, so every piece
+        of a lap is contiguous. Trackpoints are yielded wrapped.
+        """
+        by, marks = self.by, self.marks
+        lap, part, distance = -1, 0, 0.0
+
+        for event, name, elem in WorkoutStream(self._file):
+            trackpoint = None
+            if name == "Lap" and event == "start":
+                lap += 1
+                if by == WorkoutSplitter.LAP:
+                    part = max(part, lap if marks is None else bisect_right(marks, lap))
+
+            elif name == "Trackpoint":
+                trackpoint = Trackpoint(elem)
+                if by == WorkoutSplitter.TIME:
+                    time = TCX.to_epoch(trackpoint.time)
+                    part = max(part, bisect_right(marks, time))
+                elif by == WorkoutSplitter.DISTANCE:
+                    if trackpoint.distance is not None:
+                        distance = trackpoint.distance
+                    part = max(part, bisect_right(marks, distance))
+
+            yield event, name, elem, lap, part, trackpoint
+
+    def __plan(self):
+        """
+        First pass: statistics of the lap pieces, keyed by (lap, part),
+        and the distance each part is counted from.
+        """
+        pieces, bases, laps = {}, {}, {}
+        previous, distance = None, None
+
+        for event, name, elem, lap, part, trackpoint in self.__parts():
+            if trackpoint is not None:
+                time = TCX.to_epoch(trackpoint.time)
+                if part not in bases:
+                    bases[part] = (distance or 0.0) if part else 0.0
+                if trackpoint.distance is not None:
+                    distance = trackpoint.distance
+
+                stats = pieces.get((lap, part))
+                if stats is None:
+                    same_lap = previous is not None and previous[2] == lap
+                    stats = pieces[lap, part] = LapStats(
+                        previous[:2] if same_lap else None
+                    )
+                stats.add(
+                    time, trackpoint.distance, trackpoint.heart_rate, trackpoint.cadence
+                )
+                previous = (time, distance, lap)
+
+            elif name == "Lap" and event == "end":
+                totals = Lap(elem)
+                laps[lap] = (totals.total_seconds, totals.distance, totals.calories)
+                pieces.setdefault((lap, part), LapStats())
+                bases.setdefault(part, (distance or 0.0) if part else 0.0)
+
+        # Share the totals of the split laps between the pieces
+        for lap, (total_seconds, distance, calories) in laps.items():
+            split = [stats for (n, _), stats in pieces.items() if n == lap]
+            if len(split) < 2:
+                continue
+
+            for stats in split[1:]:
+                stats.total_seconds = stats.elapsed or 0.0
+                stats.distance = stats.covered or 0.0
+
+            others = split[1:]
+            first = split[0]
+            first.total_seconds = max(
+                0.0, total_seconds - sum(s.total_seconds for s in others)
+            )
+            first.distance = max(0.0, distance - sum(s.distance for s in others))
+            for stats in split:
+                share = stats.total_seconds / total_seconds if total_seconds else 0.0
+                stats.calories = calories * share
+
+        return pieces, bases
+
+    def __write(self, output, pieces, bases):
+        """
+        Second pass: streams the events into the outputs of the parts.
+        Elements preceding the first lap are replayed into every output,
+        elements following the laps are written to all of them.
+        """
+        files, writers, head = [], {}, []
+        lap_elem, totals, track = None, [], None
+        writer, current, in_tracks, track_open = None, None, False, False
+
+        with ExitStack() as stack, Profiler.current.phase("serialize"):
+
+            def start(lap, part):
+                """
+                Starts the piece of the lap in the output of the part.
+                """
+                stats = pieces[lap, part]
+                copy = lap_elem.makeelement(lap_elem.tag, lap_elem.attrib)
+                copy.extend(deepcopy(total) for total in totals)
+                piece = Lap(copy)
+                if stats.previous is not None:
+                    piece.start_time = TCX.from_epoch(stats.start_time)
+                stats.apply(piece)
+
+                writer = writers.get(part)
+                if writer is None:
+                    files.append(output(len(files) + 1))
+                    f = stack.enter_context(open_output(files[-1]))
+                    writer = writers[part] = TCXWriter(f)
+                    writer.declaration()
+                    for event, elem in head:
+                        if event == "start":
+                            writer.start(elem)
+                        else:
+                            writer.write(elem)
+                    writer.write(WorkoutSplitter.__id(copy, piece.start_time))
+
+                writer.start(copy)
+                for total in copy:
+                    writer.write(total)
+                return writer
+
+            for event, name, elem, lap, part, trackpoint in self.__parts():
+                if lap_elem is None:
+                    if name == "Lap":
+                        lap_elem, totals, in_tracks = elem, [], False
+                        writer, current = None, None
+                    elif not writers:
+                        if event == "start" or name != WorkoutSplitter.__Id:
+                            head.append((event, elem))
+                    else:
+                        for w in writers.values():
+                            if name not in WorkoutSplitter.__Containers:
+                                w.write(elem)
+                            elif event == "start":
+                                w.start(elem)
+                            else:
+                                w.end(elem)
+                    continue
+
+                if name == "Trackpoint":
+                    if writer is None or current != part:
+                        if writer is not None:
+                            if track_open:
+                                writer.end(track)
+                            writer.end(lap_elem)
+                        writer, current, track_open = start(lap, part), part, False
+
+                    if not track_open:
+                        writer.start(track)
+                        track_open = True
+
+                    base = bases[part]
+                    if base and trackpoint.distance is not None:
+                        trackpoint.distance = round(trackpoint.distance - base, 2)
+                    writer.write(elem)
+
+                elif name == "Track":
+                    in_tracks = True
+                    if event == "start":
+                        track, track_open = elem, False
+                    elif track_open:
+                        writer.end(elem)
+                        track_open = False
+
+                elif not in_tracks and name != "Lap":
+                    totals.append(elem)
+
+                else:
+                    if writer is None:
+                        writer, current = start(lap, part), part
+                    if name == "Lap":
+                        writer.end(elem)
+                        lap_elem = None
+                    else:
+                        writer.write(elem)
+
+        return files
+
+    @staticmethod
+    def __id(lap, start_time):
+        """
+        New Id element of the part, its start time.
+        """
+        tag = TCX.qualify(WorkoutSplitter.__Id, ET.QName(lap).namespace)
+        elem = lap.makeelement(tag)
+        elem.text = TCX.to_tcx_time_string(start_time)
+        return elem
+
+
+class WorkoutMerger:
+    """
+    Streaming merge of overlapping recordings of the same session
+    from multiple devices, e.g. a watch (position, heart rate)
+    and a smart trainer (power, cadence).
+
+    Trackpoints of all the files are merged by time with a heap
+    (k-way merge). Trackpoints of different files within the window
+    (seconds), at most one of each file, are fused into one trackpoint,
+    which takes every value from the first file that has it and keeps
+    its time. Exact duplicates are dropped. Id, laps and the rest
+    of the workout come from the first file: each lap gets the fused
+    trackpoints since its start time in a single track, with heart rate,
+    cadence and maximum speed recomputed from them (see LapStats).
+    Start and total time of the first and the last lap cover the trackpoints
+    of the other files before and after them, distance and calories are kept.
+
+    Every file is streamed twice, to collect the statistics of the laps
+    and to write the merged workout, so only the trackpoints within
+    the window are kept in memory.
+    """
+
+    __Containers = {"TrainingCenterDatabase", "Activities", "Activity"}
+    __Time = "Time"
+    __LapStart, __Trackpoint = 0, 1
+
+    def __init__(self, files, window=1.0):
+        if len(files) < 2:
+            raise ValueError("At least two workouts are required")
+        if window < 0:
+            raise ValueError("Window should not be negative")
+
+        self._files = list(files)
+        self.window = window
+
+    def merge(self, output):
+        """
+        Merges the workouts into the output file.
+        """
+        with Profiler.current.phase("compute"):
+            starts, laps = self.__plan()
+        self.__write(output, starts, laps)
+
+    def __items(self, n, file):
+        """
+        Streams (timestamp, kind, file, index, trackpoint) of the trackpoints
+        of the file and the starts of the laps of the first file.
+        Trackpoints are taken out of the stream, so they outlive it.
+        """
+        tag = None
+        for index, (event, name, elem) in enumerate(WorkoutStream(file)):
+            if name == "Trackpoint":
+                # Time is looked up directly, without indexing the trackpoint
+                if tag is None:
+                    tag = TCX.qualify(WorkoutMerger.__Time, ET.QName(elem).namespace)
+                timestamp = TCX.parse_epoch(elem.findtext(tag))
+                trackpoint = Trackpoint(WorkoutMerger.__take(elem))
+                yield timestamp, WorkoutMerger.__Trackpoint, n, index, trackpoint
+            elif n == 0 and name == "Lap" and event == "start":
+                timestamp = TCX.to_epoch(Lap(elem).start_time)
+                yield timestamp, WorkoutMerger.__LapStart, n, index, None
+
+    @staticmethod
+    def __take(elem):
+        """
+        Moves the content of the element into a new element,
+        which keeps all the namespaces in scope, so it is serialized
+        with the prefixes of the file. The streamed element is disposed.
+        """
+        taken = ET.Element(elem.tag, elem.attrib, nsmap=elem.nsmap)
+        taken.text = elem.text
+        taken.extend(list(elem))
+        return taken
+
+    def __fused(self, starts):
+        """
+        Streams the fused trackpoints of all the files as (timestamp, trackpoint).
+        Start times of the laps of the first file are appended to the starts
+        in between the trackpoints, and no trackpoints across a lap start
+        are fused.
+        """
+        sources = [self.__items(n, file) for n, file in enumerate(self._files)]
+        window, group, start = self.window, {}, None
+
+        def fuse():
+            """
+            Fuses the group into the trackpoint of the first file in it.
+            """
+            first, *others = (group[n] for n in sorted(group))
+            for _, trackpoint in others:
+                first[1].fuse(trackpoint)
+            group.clear()
+            return first
+
+        for timestamp, kind, n, _, trackpoint in heapq.merge(*sources):
+            if group and (
+                n in group
+                or kind == WorkoutMerger.__LapStart
+                or timestamp - start > window
+            ):
+                if n in group and WorkoutMerger.__duplicate(
+                    group[n], timestamp, trackpoint
+                ):
+                    continue
+                yield fuse()
+
+            if kind == WorkoutMerger.__LapStart:
+                starts.append(timestamp)
+            else:
+                if not group:
+                    start = timestamp
+                group[n] = (timestamp, trackpoint)
+
+        if group:
+            yield fuse()
+
+    @staticmethod
+    def __duplicate(item, timestamp, trackpoint):
+        """
+        Whether the trackpoint is an exact duplicate of the item.
+        """
+        if item[0] != timestamp:
+            return False
+        return ET.tostring(item[1]._element, with_tail=False) == ET.tostring(
+            trackpoint._element, with_tail=False
+        )
+
+    def __plan(self):
+        """
+        First pass: start times of the laps of the first file
+        and the statistics of the fused trackpoints of each lap.
+        """
+        starts, laps = [], {}
+        for timestamp, trackpoint in self.__fused(starts):
+            # Trackpoints preceding the first lap belong to it
+            lap = max(0, len(starts) - 1)
+            stats = laps.get(lap)
+            if stats is None:
+                stats = laps[lap] = LapStats()
+
+            stats.add(
+                timestamp,
+                trackpoint.distance,
+                trackpoint.heart_rate,
+                trackpoint.cadence,
+            )
+
+        if not starts:
+            raise ValueError(f"[{self._files[0]}] workout has no laps")
+        return starts, laps
+
+    def __write(self, output, starts, laps):
+        """
+        Second pass: streams the first file into the output,
+        replacing the tracks of each lap with one track
+        of the fused trackpoints of the lap.
+        """
+        seen = []
+        trackpoints = (
+            (max(0, len(seen) - 1), trackpoint._element)
+            for _, trackpoint in self.__fused(seen)
+        )
+        pending = next(trackpoints, None)
+        lap_elem, n, written = None, -1, False
+
+        with open_output(output) as f, Profiler.current.phase("serialize"):
+            writer = TCXWriter(f)
+            writer.declaration()
+
+            for event, name, elem in WorkoutStream(self._files[0]):
+                if lap_elem is None:
+                    if name == "Lap":
+                        lap_elem, n, written = elem, n + 1, False
+                    elif name not in WorkoutMerger.__Containers:
+                        writer.write(elem)
+                    elif event == "start":
+                        writer.start(elem)
+                    else:
+                        writer.end(elem)
+                    continue
+
+                if not written and name in ("Track", "Lap"):
+                    # Totals of the lap are complete, the tracks follow
+                    if n in laps:
+                        WorkoutMerger.__apply(laps[n], Lap(lap_elem), starts[n])
+                    writer.start(lap_elem)
+                    for total in lap_elem:
+                        if total is elem:
+                            break
+                        writer.write(total)
+
+                    track = None
+                    while pending is not None and pending[0] <= n:
+                        if track is None:
+                            track = WorkoutMerger.__track(lap_elem)
+                            writer.start(track)
+                        writer.write(pending[1])
+                        pending = next(trackpoints, None)
+                    if track is not None:
+                        writer.end(track)
+                    written = True
+
+                if name == "Lap":
+                    writer.end(elem)
+                    lap_elem = None
+                elif written and name not in ("Track", "Trackpoint"):
+                    writer.write(elem)
+
+    @staticmethod
+    def __apply(stats, lap, start):
+        """
+        Applies the statistics to the lap, extending its start time
+        and total time to the fused trackpoints that precede or follow it.
+        """
+        if stats.start_time < start:
+            start = stats.start_time
+            lap.start_time = TCX.from_epoch(start)
+        elapsed = stats.finish_time - start
+        if elapsed > lap.total_seconds:
+            stats.total_seconds = elapsed
+        stats.apply(lap)
+
+    @staticmethod
+    def __track(lap):
+        """
+        New Track element of the lap.
+        """
+        return lap.makeelement(TCX.qualify("Track", ET.QName(lap).namespace))
+
+
+class WorkoutDistance:
+    """
+    Recomputes the distance of the workout from the GPS positions,
+    e.g. of an outdoor ride recorded with a wrong wheel size.
+
+    The file is streamed twice. The first pass collects the trackpoint
+    columns, then the distances between the consecutive positions are
+    computed over the whole columns at once and accumulated. The second
+    pass writes the distances of the trackpoints and the lap totals.
+    A new track means the timer was stopped, so the path restarts
+    at the first position of each track and the jump across the pause
+    is not counted. Trackpoints without position keep the distance
+    of the last position before them.
+    With 'altitude' the climbs and descents are added to the distances.
+    """
+
+    HAVERSINE = "haversine"
+    VINCENTY = "vincenty"
+    METHODS = (HAVERSINE, VINCENTY)
+
+    EARTH_RADIUS = 6371008.8
+
+    # WGS-84 ellipsoid
+    __Axis = 6378137.0
+    __Flattening = 1 / 298.257223563
+
+    def __init__(self, file, method=HAVERSINE, altitude=False):
+        if method not in WorkoutDistance.METHODS:
+            raise ValueError(f"Unknown distance method: {method}")
+        self._file = file
+        self.method = method
+        self.altitude = altitude
+
+    def save(self, output):
+        """
+        Writes the workout with the recomputed distances to the output file.
+        """
+        WorkoutStream(self._file).save(output, transform=self.transform())
+
+    def transform(self):
+        """
+        Computes the distances and returns the transform that sets them.
+        """
+        columns, laps, tracks = self.__collect()
+
+        with Profiler.current.phase("compute"):
+            distances = self.distances(columns, tracks)
+
+            stats, end = [], 0
+            for size in laps:
+                start, end = end, end + size
+                stats.append(WorkoutDistance.__stats(columns, distances, start, end))
+        return Distance(distances, stats)
+
+    def distances(self, columns, tracks=()):
+        """
+        Cumulative distance (meters) of each trackpoint of the columns.
+        The segment leading to the first position at or after each of
+        the track starts (indices of the trackpoints) is not counted.
+        """
+        positioned = bytes(
+            map(min, columns.mask(Columns.LATITUDE), columns.mask(Columns.LONGITUDE))
+        )
+        if not any(positioned):
+            raise ValueError("Workout has no positions to compute the distance from")
+
+        latitudes = array("d", compress(columns.values(Columns.LATITUDE), positioned))
+        longitudes = array("d", compress(columns.values(Columns.LONGITUDE), positioned))
+        if self.method == WorkoutDistance.VINCENTY:
+            segments = WorkoutDistance.vincenty(latitudes, longitudes)
+        else:
+            segments = WorkoutDistance.haversine(latitudes, longitudes)
+
+        if self.altitude:
+            altitudes = array(
+                "d", compress(columns.values(Columns.ALTITUDE), positioned)
+            )
+            present = bytes(compress(columns.mask(Columns.ALTITUDE), positioned))
+
+            # Climbs between the positions without altitude are zero
+            climbs = map(
+                mul,
+                map(sub, altitudes[1:], altitudes[:-1]),
+                map(min, present[1:], present[:-1]),
+            )
+            segments = array("d", map(math.hypot, segments, climbs))
+
+        # Segment n leads to the position n + 1, the first position
+        # at or after the track start is preceded by 'count' positions
+        counts = array("l", [0])
+        counts.extend(accumulate(positioned))
+        for start in tracks:
+            count = counts[start]
+            if 0 < count <= len(segments):
+                segments[count - 1] = 0.0
+
+        # Distance at the n-th position, the first position is at zero,
+        # so each trackpoint picks it by the number of positions up to it
+        cumulative = array("d", [0.0, 0.0])
+        cumulative.extend(accumulate(segments))
+        return array("d", map(cumulative.__getitem__, counts[1:]))
+
+    @staticmethod
+    def haversine(latitudes, longitudes):
+        """
+        Great-circle distances between the consecutive points (meters).
+        """
+        phi = array("d", map(math.radians, latitudes))
+        lam = array("d", map(math.radians, longitudes))
+        cos_phi = array("d", map(math.cos, phi))
+
+        half = repeat(0.5)
+        dphi = array("d", map(math.sin, map(mul, map(sub, phi[1:], phi[:-1]), half)))
+        dlam = array("d", map(math.sin, map(mul, map(sub, lam[1:], lam[:-1]), half)))
+        a = map(
+            add,
+            map(mul, dphi, dphi),
+            map(mul, map(mul, cos_phi[1:], cos_phi[:-1]), map(mul, dlam, dlam)),
+        )
+        diameter = 2 * WorkoutDistance.EARTH_RADIUS
+        return array("d", map(mul, map(math.asin, map(math.sqrt, a)), repeat(diameter)))
+
+    @staticmethod
+    def vincenty(latitudes, longitudes):
+        """
+        Distances between the consecutive points on the WGS-84 ellipsoid
+        (meters), solving the inverse problem with the Vincenty's formulae.
+
+        Only the reduced latitudes are computed over the whole columns,
+        the iteration itself runs per pair of points. Run over the columns
+        at once, every iteration would take a dozen passes, which is
+        several times slower than the per-pair loop converging in a few steps.
+        """
+        f = WorkoutDistance.__Flattening
+        tangents = map(mul, map(math.tan, map(math.radians, latitudes)), repeat(1 - f))
+        reduced = array("d", map(math.atan, tangents))
+        sin_u = array("d", map(math.sin, reduced))
+        cos_u = array("d", map(math.cos, reduced))
+        lam = array("d", map(math.radians, longitudes))
+
+        return array(
+            "d",
+            map(
+                WorkoutDistance.__inverse,
+                sin_u[:-1],
+                cos_u[:-1],
+                sin_u[1:],
+                cos_u[1:],
+                map(sub, lam[1:], lam[:-1]),
+            ),
+        )
+
+    @staticmethod
+    def __inverse(sin_u1, cos_u1, sin_u2, cos_u2, delta):
+        # Distance between two points given by the sines and cosines
+        # of their reduced latitudes and the difference of the longitudes
+        a, f = WorkoutDistance.__Axis, WorkoutDistance.__Flattening
+        b = a * (1 - f)
+
+        lam = delta
+        for _ in range(100):
+            sin_lam, cos_lam = math.sin(lam), math.cos(lam)
+            sin_sigma = math.hypot(
+                cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam
+            )
+            if sin_sigma == 0:
+                return 0.0
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = math.atan2(sin_sigma, cos_sigma)
+            sin_alpha = cos_u1 * cos_u2 * sin_lam / sin_sigma
+            cos2_alpha = 1 - sin_alpha * sin_alpha
+            cos_2sm = (
+                cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha if cos2_alpha else 0.0
+            )
+            cos2_2sm = cos_2sm * cos_2sm
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            previous, lam = lam, delta + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sm + c * cos_sigma * (2 * cos2_2sm - 1))
+            )
+            if abs(lam - previous) < 1e-12:
+                break
+        else:
+            # Nearly antipodal points, never the case of a workout
+            return WorkoutDistance.EARTH_RADIUS * sigma
+
+        u2 = cos2_alpha * (a * a - b * b) / (b * b)
+        k1 = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        k2 = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        sin2_sigma = sin_sigma * sin_sigma
+        correction = k2 / 6 * cos_2sm * (4 * sin2_sigma - 3) * (4 * cos2_2sm - 3)
+        bracket = cos_sigma * (2 * cos2_2sm - 1) - correction
+        delta_sigma = k2 * sin_sigma * (cos_2sm + k2 / 4 * bracket)
+        return b * k1 * (sigma - delta_sigma)
+
+    def __collect(self):
+        """
+        Columns of all the trackpoints, the number of trackpoints of each lap
+        and the index of the first trackpoint of each track.
+        """
+        columns, laps, tracks, count = Columns(), [], [], 0
+        with Profiler.current.phase("parse"):
+            for event, name, elem in WorkoutStream(self._file):
+                if event == "start":
+                    if name == "Lap":
+                        count = 0
+                    elif name == "Track":
+                        tracks.append(len(columns))
+                elif name == "Trackpoint":
+                    columns.append(elem)
+                    count += 1
+                elif name == "Lap":
+                    laps.append(count)
+        return columns, laps, tracks
+
+    @staticmethod
+    def __stats(columns, distances, start, end):
+        """
+        Distance and maximum speed of the lap of the trackpoints [start, end).
+        The distance covered since the previous lap is accounted to the lap.
+        """
+        stats = LapStats()
+        if start == end:
+            return stats
+
+        stats.distance = distances[end - 1] - (distances[start - 1] if start else 0.0)
+
+        mask = columns.mask(Columns.TIME)[start:end]
+        times = array("d", compress(columns.values(Columns.TIME)[start:end], mask))
+        covered = array("d", compress(distances[start:end], mask))
+
+        intervals = map(sub, times[1:], times[:-1])
+        covered = map(sub, covered[1:], covered[:-1])
+        stats.max_speed = max(
+            (d / t for d, t in zip(covered, intervals) if t > 0), default=None
+        )
+        return stats
+
+
+class WorkoutHeader:
+    """
+    Fast reader of the workout metadata, that doesn't parse the XML tree.
+
+    The raw file is scanned for the workout Id, Sport and the lap headers
+    (StartTime and lap totals), while the time boundaries of each track
+    are found by looking for the first <Time> after the start of the track
+    and for the last <Time> before its end, searching backwards.
+    The scan moves forward from one boundary to the next: each lap header
+    is searched right after the end of the previous lap, and the tracks
+    are skipped by looking for their closing tags with plain byte searches.
+    So the whole file is still read once, but nothing besides the lap
+    headers and the track boundaries is parsed. Plain files are
+    memory-mapped, compressed files are decompressed in full.
+    Trackpoints are assumed to be recorded in the chronological order
+    and are counted only on demand.
+    """
+
+    __Root = re.compile(rb"<([\w.-]+:)?TrainingCenterDatabase[\s>]")
+
+    def __init__(self, file, trackpoints=False):
+        self._file = file
+        self._trackpoints = trackpoints
+
+    def summary(self):
+        """
+        Summarizes the workout, its laps and tracks.
+        Trackpoints are None, unless they are counted,
+        and so are the trackpoint totals of the laps and the workout.
+        """
+        with open_input(self._file) as source:
+            data = source if isinstance(source, mmap.mmap) else source.read()
+            return self.__summarize(data)
+
+    def __summarize(self, data):
+        root = WorkoutHeader.__Root.search(data)
+        if root is None:
+            raise ValueError("TrainingCenterDatabase element is not found")
+        tags = WorkoutHeader.__tags(root.group(1) or b"")
+
+        workout_id = tags["Id"].search(data)
+        activity = tags["Activity"].search(data)
+
+        summaries, position = [], 0
+        while True:
+            lap = tags["Lap"].search(data, position)
+            if lap is None:
+                break
+            n = len(summaries)
+            tracks, header_end, position = self.__tracks(data, tags, lap.end())
+            header = data[lap.end() : header_end]
+
+            totals = {}
+            for name in ("DistanceMeters", "Calories"):
+                total = tags[name].search(header)
+                if total is None:
+                    raise ValueError(f"Lap #{n} has no {name}")
+                totals[name] = float(total.group(1))
+
+            optional = {}
+            for name in ("Cadence", "AverageHeartRateBpm", "MaximumHeartRateBpm"):
+                value = tags[name].search(header)
+                optional[name] = int(float(value.group(1))) if value else None
+
+            summaries.append(
+                LapSummary(
+                    TCX.parse_time(lap.group(1).decode("utf-8")),
+                    totals["DistanceMeters"],
+                    totals["Calories"],
+                    optional["Cadence"],
+                    optional["AverageHeartRateBpm"],
+                    optional["MaximumHeartRateBpm"],
+                    tracks,
+                )
+            )
+
+        return WorkoutSummary(
+            WorkoutHeader.__text(workout_id),
+            WorkoutHeader.__text(activity),
+            summaries,
+        )
+
+    def __tracks(self, data, tags, start):
+        # Summarizes the tracks of the lap, returns them together with
+        # the end of the lap header and the end of the lap.
+        # The closing tag of the lap is only looked for up to the next track,
+        # so the trackpoints are never scanned twice.
+        tracks, header_end = [], None
+        open_tag, close_tag, close_lap = tags["Track"], tags["/Track"], tags["/Lap"]
+
+        while True:
+            track_start = data.find(open_tag, start)
+            limit = track_start if track_start >= 0 else len(data)
+            lap_end = data.find(close_lap, start, limit)
+            if lap_end >= 0 or track_start < 0:
+                lap_end = len(data) if lap_end < 0 else lap_end
+                if header_end is None:
+                    header_end = lap_end
+                return tracks, header_end, lap_end
+
+            if header_end is None:
+                header_end = track_start
+            track_start += len(open_tag)
+            track_end = data.find(close_tag, track_start)
+            track_end = len(data) if track_end < 0 else track_end
+
+            trackpoints = None
+            if self._trackpoints:
+                trackpoints = sum(
+                    1 for _ in tags["Trackpoint"].finditer(data, track_start, track_end)
+                )
+            tracks.append(
+                TrackSummary(
+                    WorkoutHeader.__time(data, tags, track_start, track_end),
+                    WorkoutHeader.__time(data, tags, track_start, track_end, last=True),
+                    trackpoints,
+                )
+            )
+            start = track_end + len(close_tag)
+
+    @staticmethod
+    def __time(data, tags, start, end, last=False):
+        tag = tags["Time"]
+        i = data.rfind(tag, start, end) if last else data.find(tag, start, end)
+        if i < 0:
+            return None
+        i += len(tag)
+        return TCX.parse_time(data[i : data.find(b"<", i, end)].decode("utf-8"))
+
+    @staticmethod
+    def __text(match):
+        return match.group(1).decode("utf-8").strip() if match is not None else None
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def __tags(prefix):
+        # Literal tags and patterns for the namespace prefix of the document,
+        # patterns start with a literal, so they are searched fast
+        p = re.escape(prefix)
+        value = rb">\s*<" + p + rb"Value>([^<]*)<"
+        return {
+            "Id": re.compile(b"<" + p + rb"Id>([^<]*)<"),
+            "Activity": re.compile(b"<" + p + rb"Activity\s[^>]*?Sport=[\"']([^\"']*)"),
+            "Lap": re.compile(b"<" + p + rb"Lap\s[^>]*?StartTime=[\"']([^\"']*)[^>]*>"),
+            "Track": b"<" + prefix + b"Track>",
+            "/Track": b"</" + prefix + b"Track>",
+            "/Lap": b"</" + prefix + b"Lap>",
+            "Time": b"<" + prefix + b"Time>",
+            "Trackpoint": re.compile(b"<" + p + rb"Trackpoint[\s>]"),
+            "DistanceMeters": re.compile(b"<" + p + rb"DistanceMeters>([^<]*)<"),
+            "Calories": re.compile(b"<" + p + rb"Calories>([^<]*)<"),
+            "Cadence": re.compile(b"<" + p + rb"Cadence>([^<]*)<"),
+            "AverageHeartRateBpm": re.compile(
+                b"<" + p + rb"AverageHeartRateBpm[^>]*" + value
+            ),
+            "MaximumHeartRateBpm": re.compile(
+                b"<" + p + rb"MaximumHeartRateBpm[^>]*" + value
+            ),
+        }
+
+
+class WorkoutValidator:
+    """
+    Validator of the workouts against the TrainingCenterDatabase v2 schema.
+
+    The schema is kept in the 'schemas' directory next to this script,
+    so no network access is needed. It is compiled once per process
+    on the first use and reused for all the validated files.
+    """
+
+    SCHEMA = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "schemas",
+        "TrainingCenterDatabasev2.xsd",
+    )
+    MAX_ERRORS = 10
+
+    def __init__(self, schema=SCHEMA):
+        self._schema = schema
+
+    def validate(self, file):
+        """
+        Validates the workout file.
+        Returns the list of errors (up to MAX_ERRORS), empty for a valid workout.
+        """
+        profiler = Profiler.current
+        schema, namespace = WorkoutValidator.__compile(self._schema)
+        try:
+            with open_input(file) as source, profiler.phase("parse"):
+                tree = ET.parse(source)
+        except ET.XMLSyntaxError as e:
+            return [str(e)]
+
+        with profiler.phase("compute"):
+            if schema.validate(tree):
+                return []
+        # Elements of the schema namespace are reported by their local names
+        return [
+            f"line {e.line}: {e.message.replace(namespace, '')}"
+            for e in islice(schema.error_log, WorkoutValidator.MAX_ERRORS)
+        ]
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def __compile(file):
+        # Compiled schema and its namespace, as it prefixes the names in errors
+        document = ET.parse(file)
+        namespace = "{" + document.getroot().get("targetNamespace", "") + "}"
+        return ET.XMLSchema(document), namespace
+
+
+class WorkoutCache:
+    """
+    On-disk cache of the workout summaries.
+
+    Entries are keyed by the absolute path, size and modification time
+    of the workout file, so a modified file never hits a stale entry.
+    Each entry holds the workout, lap and track summaries and,
+    if they were collected, the trackpoint columns in a compact binary form.
+    When the cache grows over its size limit, the least recently used
+    entries are evicted. The size of the cache is scanned once and then
+    tracked in memory, so the directory is scanned again only when
+    the limit may be exceeded. Worker processes don't see each other's
+    entries, so the batch actions evict once more when they are done.
+    """
+
+    VERSION = 1
+
+    __Magic = b"TCXC"
+    __Header = struct.Struct("<4sHI")
+    __Suffix = ".summary"
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        # Size of the entries as known to this process, None until scanned
+        self._size = None
+
+    def get(self, file, columns=False):
+        """
+        Cached summary of the workout file or None.
+        With 'columns' only the entries holding trackpoint columns are returned.
+        """
+        try:
+            key, entry = self.__entry(file)
+            with open(entry, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        try:
+            summary = WorkoutCache.__decode(data, key, columns)
+        except Exception:
+            summary = None
+
+        if summary is not None:
+            # Modification time of the entry is its last use
+            WorkoutCache.__touch(entry)
+        return summary
+
+    def put(self, file, summary):
+        """
+        Stores the summary of the workout file and, if the cache
+        may have grown over its limit, evicts the least recently used entries.
+        The cache is best effort: failures to write it are ignored.
+        """
+        try:
+            key, entry = self.__entry(file)
+            os.makedirs(self.directory, exist_ok=True)
+
+            data = WorkoutCache.__encode(summary, key)
+            try:
+                replaced = os.stat(entry).st_size
+            except OSError:
+                replaced = 0
+
+            fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp, entry)
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+
+            if self._size is not None:
+                self._size += len(data) - replaced
+            if self._size is None or self._size > self.max_size:
+                self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries,
+        until the cache fits into its size limit.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        entries = []
+        for name in names:
+            if name.endswith(WorkoutCache.__Suffix):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def __entry(self, file):
+        path = os.path.abspath(file)
+        stat = os.stat(path)
+        key = f"{WorkoutCache.VERSION}:{path}:{stat.st_size}:{stat.st_mtime_ns}"
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest() + WorkoutCache.__Suffix
+        return key, os.path.join(self.directory, name)
+
+    @staticmethod
+    def __touch(entry):
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+    @staticmethod
+    def __encode(summary, key):
+        payload, laps = [], []
+        for lap in summary.laps:
+            tracks = []
+            for track in lap.tracks:
+                columns = None
+                if track.columns is not None:
+                    payload.append(track.columns.to_bytes())
+                    columns = len(payload[-1])
+                tracks.append(
+                    dict(
+                        start_time=WorkoutCache.__time(track.start_time),
+                        finish_time=WorkoutCache.__time(track.finish_time),
+                        trackpoints=track.trackpoints,
+                        columns=columns,
+                    )
+                )
+            laps.append(
+                dict(
+                    start_time=WorkoutCache.__time(lap.start_time),
+                    distance=lap.distance,
+                    calories=lap.calories,
+                    cadence=lap.cadence,
+                    heart_rate=lap.heart_rate,
+                    max_heart_rate=lap.max_heart_rate,
+                    tracks=tracks,
+                )
+            )
+
+        meta = json.dumps(
+            dict(
+                key=key,
+                workout_id=summary.workout_id,
+                activity=summary.activity,
+                laps=laps,
+            ),
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+        header = WorkoutCache.__Header.pack(
+            WorkoutCache.__Magic, WorkoutCache.VERSION, len(meta)
+        )
+        return header + meta + b"".join(payload)
+
+    @staticmethod
+    def __decode(data, key, columns=False):
+        magic, version, size = WorkoutCache.__Header.unpack_from(data)
+        if magic != WorkoutCache.__Magic or version != WorkoutCache.VERSION:
+            return None
+
+        offset = WorkoutCache.__Header.size
+        meta = json.loads(data[offset : offset + size].decode("utf-8"))
+        if meta["key"] != key:
+            return None
+
+        if columns and any(
+            track["columns"] is None for lap in meta["laps"] for track in lap["tracks"]
+        ):
+            return None
+
+        offset += size
+        laps = []
+        for lap in meta["laps"]:
+            tracks = []
+            for track in lap["tracks"]:
+                track_columns = None
+                if track["columns"] is not None:
+                    end = offset + track["columns"]
+                    track_columns = Columns.from_bytes(data[offset:end])
+                    offset = end
+                tracks.append(
+                    TrackSummary(
+                        WorkoutCache.__datetime(track["start_time"]),
+                        WorkoutCache.__datetime(track["finish_time"]),
+                        track["trackpoints"],
+                        track_columns,
+                    )
+                )
+            laps.append(
+                LapSummary(
+                    WorkoutCache.__datetime(lap["start_time"]),
+                    lap["distance"],
+                    lap["calories"],
+                    lap["cadence"],
+                    lap["heart_rate"],
+                    lap["max_heart_rate"],
+                    tracks,
+                )
+            )
+
+        return WorkoutSummary(meta["workout_id"], meta["activity"], laps)
+
+    @staticmethod
+    def __time(time):
+        return time.isoformat() if time is not None else None
+
+    @staticmethod
+    def __datetime(time):
+        return datetime.fromisoformat(time) if time is not None else None
+
+
+class WorkoutCatalog:
+    """
+    SQLite catalog of the workout and lap metadata.
+
+    Files are indexed incrementally: a file is summarized again only
+    when its size or modification time differs from the catalog.
+    Times are stored in UTC as "YYYY-MM-DD HH:MM:SS" strings,
+    durations in seconds and distances in meters.
+    """
+
+    __Schema = """
+        CREATE TABLE IF NOT EXISTS workouts (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            workout_id TEXT,
+            activity TEXT,
+            start_time TEXT,
+            finish_time TEXT,
+            duration REAL,
+            distance REAL,
+            calories REAL,
+            heart_rate REAL,
+            max_heart_rate INTEGER,
+            cadence REAL,
+            laps INTEGER,
+            trackpoints INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS laps (
+            path TEXT NOT NULL REFERENCES workouts (path) ON DELETE CASCADE,
+            lap INTEGER NOT NULL,
+            start_time TEXT,
+            finish_time TEXT,
+            duration REAL,
+            distance REAL,
+            calories REAL,
+            heart_rate INTEGER,
+            max_heart_rate INTEGER,
+            cadence INTEGER,
+            trackpoints INTEGER,
+            PRIMARY KEY (path, lap)
+        );
+        CREATE INDEX IF NOT EXISTS workouts_start_time ON workouts (start_time);
+        CREATE INDEX IF NOT EXISTS workouts_activity ON workouts (activity);
+        CREATE INDEX IF NOT EXISTS workouts_distance ON workouts (distance);
+    """
+
+    WORKOUT_FIELDS = (
+        "path",
+        "size",
+        "mtime",
+        "workout_id",
+        "activity",
+        "start_time",
+        "finish_time",
+        "duration",
+        "distance",
+        "calories",
+        "heart_rate",
+        "max_heart_rate",
+        "cadence",
+        "laps",
+        "trackpoints",
+    )
+    LAP_FIELDS = (
+        "path",
+        "lap",
+        "start_time",
+        "finish_time",
+        "duration",
+        "distance",
+        "calories",
+        "heart_rate",
+        "max_heart_rate",
+        "cadence",
+        "trackpoints",
+    )
+
+    def __init__(self, file):
+        self._db = sqlite3.connect(file)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript(WorkoutCatalog.__Schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def index(self, paths, jobs=1, ordered=True, stream=sys.__stdout__):
+        """
+        Indexes new and changed workouts found in the given files and directories.
+        Workouts that were removed from the indexed directories
+        are removed from the catalog.
+        """
+        files = [os.path.abspath(f) for f, _ in find_workouts(paths)]
+        known = {
+            row["path"]: (row["size"], row["mtime"])
+            for row in self._db.execute("SELECT path, size, mtime FROM workouts")
+        }
+
+        changed = []
+        for f in files:
+            try:
+                stat = os.stat(f)
+            except OSError:
+                changed.append(f)
+                continue
+            if known.get(f) != (stat.st_size, stat.st_mtime_ns):
+                changed.append(f)
+
+        found = set(files)
+        directories = [os.path.abspath(p) + os.sep for p in paths if os.path.isdir(p)]
+        removed = [
+            f
+            for f in known
+            if f not in found and any(f.startswith(d) for d in directories)
+        ]
+
+        failed = 0
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM workouts WHERE path = ?", ((f,) for f in removed)
+            )
+
+            results = run_parallel(WorkoutCatalog.summarize, changed, jobs, ordered)
+            for n, (f, workout, laps, error) in enumerate(results, 1):
+                if error is not None:
+                    failed += 1
+                    print(
+                        f"[{n}/{len(changed)}] Failed to index [{f}]: {error}",
+                        file=stream,
+                    )
+                    continue
+
+                self._db.execute("DELETE FROM workouts WHERE path = ?", (f,))
+                self._db.execute(WorkoutCatalog.__insert("workouts"), workout)
+                self._db.executemany(WorkoutCatalog.__insert("laps"), laps)
+                print(f"[{n}/{len(changed)}] Indexed [{f}]", file=stream)
+                stream.flush()
+
+        print(
+            f"Done. Indexed: {len(changed) - failed}, "
+            + f"unchanged: {len(files) - len(changed)}, "
+            + f"removed: {len(removed)}, failed: {failed}",
+            file=stream,
+        )
+
+    def query(self, where=None, order_by=None, limit=None):
+        """
+        Workouts matching the SQL condition, sorted by the SQL expression.
+        Lap metadata could be queried with subqueries on the 'laps' table.
+        """
+        sql = "SELECT * FROM workouts"
+        if where:
+            sql += f" WHERE {where}"
+        sql += f" ORDER BY {order_by or 'start_time'}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self._db.execute(sql).fetchall()
+
+    @staticmethod
+    def summarize(file):
+        """
+        Summarizes the workout file into the catalog rows.
+        Returns (file, workout row, lap rows, error) tuple.
+        """
+        try:
+            stat = os.stat(file)
+            summary = WorkoutHeader(file, trackpoints=True).summary()
+        except Exception as e:
+            return file, None, [], str(e)
+
+        # Rows share the fields with the machine-readable info,
+        # only the times are stored in the catalog format
+        workout = summary.to_dict()
+        laps = []
+        for n, (lap, row) in enumerate(zip(summary.laps, workout["laps"])):
+            del row["tracks"]
+            row.update(
+                path=file,
+                lap=n,
+                start_time=WorkoutCatalog.__time(lap.start_time),
+                finish_time=WorkoutCatalog.__time(lap.finish_time),
+            )
+            laps.append(row)
+
+        workout.update(
+            path=file,
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            start_time=WorkoutCatalog.__time(summary.start_time),
+            finish_time=WorkoutCatalog.__time(summary.finish_time),
+            laps=len(laps),
+        )
+        return file, workout, laps, None
+
+    @staticmethod
+    def __insert(table):
+        fields = (
+            WorkoutCatalog.WORKOUT_FIELDS
+            if table == "workouts"
+            else WorkoutCatalog.LAP_FIELDS
+        )
+        return "INSERT INTO {0} ({1}) VALUES ({2})".format(
+            table, ", ".join(fields), ", ".join(":" + field for field in fields)
+        )
+
+    @staticmethod
+    def __time(time):
+        return time.strftime("%Y-%m-%d %H:%M:%S") if time is not None else None
+
+
+class TCXWriter:
+    """
+    Incremental serializer of TCX elements.
+
+    Elements are written to the text stream one by one and indented
+    according to their depth. Namespaces declared on the root element
+    are reused by all the descendants, so the TrainingCenterDatabase
+    namespace stays the default one and extension elements keep their
+    prefixes. Namespaces that are not in scope are declared on the first
+    element that needs them.
+
+    Complete elements whose namespaces are all in scope under the same
+    prefixes are serialized by lxml, keeping their original formatting,
+    which is many times faster than walking them in Python.
+    """
+
+    __Indent = "  "
+    __Declaration = re.compile(r'\s+xmlns(?::[^=\s]+)?="[^"]*"')
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._scopes = [{}]
+
+    def declaration(self):
+        """
+        Writes XML declaration.
+        """
+        self._stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+
+    def start(self, elem):
+        """
+        Writes start tag of the element, the children are expected
+        to be written separately.
+        """
+        self._indent()
+        self._stream.write(self._start_tag(elem, root=len(self._scopes) == 1) + ">")
+
+    def end(self, elem):
+        """
+        Writes end tag of the element previously started with 'start'.
+        """
+        tag = self._qname(elem.tag)
+        self._scopes.pop()
+        self._indent(force=True)
+        self._stream.write(f"</{tag}>")
+        if len(self._scopes) == 1:
+            self._stream.write("\n")
+
+    def write(self, elem):
+        """
+        Writes the complete element with all its descendants.
+        """
+        if not isinstance(elem.tag, str):
+            if elem.tag is ET.Comment:
+                self._indent()
+                self._stream.write(f"<!--{elem.text}-->")
+            return
+
+        if len(self._scopes) > 1 and self._in_scope(elem):
+            self._indent()
+            self._stream.write(self._serialize(elem))
+            return
+
+        self._indent()
+        self._stream.write(self._start_tag(elem, root=len(self._scopes) == 1))
+
+        children = len(elem) > 0
+        text = elem.text
+        if not children and not text:
+            self._stream.write("/>")
+            self._scopes.pop()
+            return
+
+        self._stream.write(">")
+        if text and (not children or text.strip()):
+            self._stream.write(TCXWriter._escape(text))
+
+        for child in elem:
+            self.write(child)
+
+        tag = self._qname(elem.tag)
+        self._scopes.pop()
+        if children:
+            self._indent(force=True)
+        self._stream.write(f"</{tag}>")
+        if len(self._scopes) == 1:
+            self._stream.write("\n")
+
+    def _in_scope(self, elem):
+        """
+        Whether the namespaces of the element are exactly the ones in scope.
+        """
+        nsmap = elem.nsmap
+        scope = self._scopes[-1]
+        if len(nsmap) != len(scope):
+            return False
+        return all(scope.get(uri) == (prefix or "") for prefix, uri in nsmap.items())
+
+    def _serialize(self, elem):
+        """
+        Serializes the element with lxml, dropping the namespace declarations
+        of its start tag, that are already in scope.
+        """
+        text = ET.tostring(elem, encoding=str, with_tail=False)
+        end = text.index(">")
+        return TCXWriter.__Declaration.sub("", text[:end]) + text[end:]
+
+    def _indent(self, force=False):
+        depth = len(self._scopes) - 1
+        if depth > 0 or force:
+            self._stream.write("\n" + TCXWriter.__Indent * depth)
+
+    def _start_tag(self, elem, root=False):
+        """
+        Builds start tag of the element, declaring the namespaces
+        that are not in scope. Opens a new namespace scope.
+        """
+        scope, declarations = self._scopes[-1], []
+
+        if root:
+            # Keep all the namespaces of the root element,
+            # starting with the default one.
+            nsmap = sorted(elem.nsmap.items(), key=lambda ns: ns[0] is not None)
+            scope = dict(scope)
+            for prefix, uri in nsmap:
+                scope[uri] = prefix or ""
+                declarations.append((prefix or "", uri))
+
+        scope = self._declare(elem.tag, elem.prefix, scope, declarations)
+        for key in elem.attrib:
+            scope = self._declare(key, None, scope, declarations, attribute=True)
+        self._scopes.append(scope)
+
+        parts = [self._qname(elem.tag)]
+        for prefix, uri in declarations:
+            xmlns = f"xmlns:{prefix}" if prefix else "xmlns"
+            parts.append(f'{xmlns}="{TCXWriter._escape(uri, quote=True)}"')
+        for key, value in elem.attrib.items():
+            parts.append(f'{self._qname(key)}="{TCXWriter._escape(value, quote=True)}"')
+        return "<" + " ".join(parts)
+
+    def _declare(self, name, prefix, scope, declarations, attribute=False):
+        if name[0] != "{":
+            return scope
+
+        uri = name[1 : name.index("}")]
+        current = scope.get(uri)
+        if current is not None and not (attribute and current == ""):
+            return scope
+
+        if attribute or prefix is not None:
+            prefix = prefix or "ns{0:d}".format(len(scope))
+            while prefix in scope.values():
+                prefix += "_"
+        else:
+            prefix = ""
+
+        scope = {u: p for u, p in scope.items() if p != prefix}
+        scope[uri] = prefix
+        declarations.append((prefix, uri))
+        return scope
+
+    def _qname(self, name):
+        if name[0] != "{":
+            return name
+
+        uri, local = name[1:].split("}", 1)
+        prefix = self._scopes[-1][uri]
+        return f"{prefix}:{local}" if prefix else local
+
+    @staticmethod
+    def _escape(text, quote=False):
+        text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        return text.replace('"', "&quot;") if quote else text
+
+
+class Profiler:
+    """
+    Per-phase wall and CPU time, element counts and peak memory
+    of the actions run in the current process.
+
+    Phases are exclusive: the time spent in a nested phase is not
+    accounted to the enclosing one, so the phases add up to the total
+    and the rest is reported as 'other'.
+    The instrumented code refers to 'Profiler.current', which is
+    a disabled profiler unless the profiling has been started.
+    """
+
+    current = None
+
+    def __init__(self, enabled=True, cprofile=None):
+        self.enabled = enabled
+        self._cprofile_file = cprofile
+        self._cprofile = None
+        self._previous = None
+        self._stack = []
+        self._phases = {}
+        self._counts = {}
+        self._started = None
+        self._switched = None
+        self._finished = None
+        self._peak_memory = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Starts profiling and makes this profiler the current one.
+        """
+        self._previous, Profiler.current = Profiler.current, self
+        tracemalloc.start()
+        if self._cprofile_file is not None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._started = (time.perf_counter(), time.process_time())
+
+    def stop(self):
+        """
+        Stops profiling and restores the previous profiler.
+        """
+        self._finished = (time.perf_counter(), time.process_time())
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self._cprofile_file)
+        self._peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        Profiler.current, self._previous = self._previous, None
+
+    def phase(self, name):
+        """
+        Context manager that accounts the time spent within to the phase.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self.__phase(name)
+
+    @contextmanager
+    def __phase(self, name):
+        self.__switch()
+        self._stack.append(name)
+        phase = self._phases.setdefault(name, dict(wall=0.0, cpu=0.0, calls=0))
+        phase["calls"] += 1
+        try:
+            yield
+        finally:
+            self.__switch()
+            self._stack.pop()
+
+    def __switch(self):
+        # Accounts the time elapsed since the last switch
+        # to the innermost phase.
+        now = (time.perf_counter(), time.process_time())
+        if self._stack:
+            phase = self._phases[self._stack[-1]]
+            phase["wall"] += now[0] - self._switched[0]
+            phase["cpu"] += now[1] - self._switched[1]
+        self._switched = now
+
+    def iterate(self, iterable, name):
+        """
+        Accounts the time spent producing each item of the iterable to the phase.
+        """
+        if not self.enabled:
+            return iterable
+        return self.__iterate(iter(iterable), name)
+
+    def __iterate(self, iterator, name):
+        # Hot loop: the phase is switched inline rather than
+        # through the context manager.
+        phase = self._phases.setdefault(name, dict(wall=0.0, cpu=0.0, calls=0))
+        stack, switch = self._stack, self.__switch
+        while True:
+            switch()
+            stack.append(name)
+            item = next(iterator, self)
+            switch()
+            stack.pop()
+            phase["calls"] += 1
+            if item is self:
+                return
+            yield item
+
+    def wrap(self, func, name):
+        """
+        Accounts the time spent in each call of the function to the phase.
+        """
+        if not self.enabled:
+            return func
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def count(self, name, n=1):
+        """
+        Increments the counter.
+        """
+        if self.enabled:
+            self._counts[name] = self._counts.get(name, 0) + int(n)
+
+    def report(self, **details):
+        """
+        Profiling results as a JSON serializable dictionary.
+        """
+        wall = self._finished[0] - self._started[0]
+        cpu = self._finished[1] - self._started[1]
+        phases = {name: dict(phase) for name, phase in self._phases.items()}
+        phases["other"] = dict(
+            wall=wall - sum(p["wall"] for p in self._phases.values()),
+            cpu=cpu - sum(p["cpu"] for p in self._phases.values()),
+            calls=1,
+        )
+
+        return dict(
+            **details,
+            wall=wall,
+            cpu=cpu,
+            phases=phases,
+            counts=dict(self._counts),
+            peak_memory=self._peak_memory,
+            cprofile=self._cprofile_file,
+        )
+
+    def save(self, file=None, **details):
+        """
+        Writes the JSON report to the file, or to stderr.
+        """
+        report = self.report(**details)
+        if file is None:
+            json.dump(report, sys.stderr, indent=2)
+            print(file=sys.stderr)
+        else:
+            with open(file, "w") as f:
+                json.dump(report, f, indent=2)
+
+
+Profiler.current = Profiler(enabled=False)
+
+
+COMPRESSION = {".gz": gzip, ".bz2": bz2, ".xz": lzma}
+WORKOUT_EXTENSIONS = (".tcx",) + tuple(".tcx" + ext for ext in COMPRESSION)
+MAGIC_NUMBERS = {b"\x1f\x8b": gzip, b"BZh": bz2, b"\xfd7zXZ\x00": lzma}
+
+
+@contextmanager
+def open_input(file):
+    """
+    Opens the workout to parse: a file name or a file object.
+
+    Compressed files (gzip, bz2, xz) are detected by the magic number
+    and decompressed on the fly, plain files are memory-mapped.
+    While profiling the file is read into memory in one go,
+    so that reading is accounted separately from parsing.
+    """
+    if not isinstance(file, (str, os.PathLike)):
+        yield file
+        return
+
+    profiler = Profiler.current
+    with open(file, "rb") as f:
+        with profiler.phase("read"):
+            magic = f.read(6)
+            f.seek(0)
+            compression = next(
+                (m for n, m in MAGIC_NUMBERS.items() if magic.startswith(n)), None
+            )
+            if compression is not None:
+                source = compression.open(f)
+            elif magic:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                source = BytesIO()
+
+            if profiler.enabled:
+                with source:
+                    source = BytesIO(source.read())
+
+        with source:
+            yield source
+
+
+@contextmanager
+def open_output(file):
+    """
+    Text stream to serialize the workout into.
+
+    The output is compressed when the file name ends
+    with one of the compression extensions (.gz, .bz2, .xz).
+    While profiling the workout is serialized into memory first,
+    so that writing is accounted separately from serialization.
+    """
+    compression = COMPRESSION.get(os.path.splitext(file)[1].lower())
+    opener = open if compression is None else compression.open
+
+    profiler = Profiler.current
+    if not profiler.enabled:
+        with opener(file, "wt", encoding="utf-8") as f:
+            yield f
+        return
+
+    buffer = StringIO()
+    yield buffer
+    with profiler.phase("write"), opener(file, "wt", encoding="utf-8") as f:
+        f.write(buffer.getvalue())
+
+
+MERGE_KINDS = {
+    "append_laps": Workout.MergeKind.APPEND_LAPS,
+    "merge_lap": Workout.MergeKind.MERGE_INTO_SINGLE_LAP,
+    "merge_track": Workout.MergeKind.MERGE_INTO_SINGLE_TRACK,
+}
+MERGE_STREAMS = "merge_streams"
+
+RESAMPLE_METHODS = ("time", "douglas-peucker", "visvalingam")
+
+INFO_FORMATS = ("text", "json", "ndjson", "csv")
+INFO_CSV_FIELDS = (
+    "file",
+    "workout_id",
+    "activity",
+    "start_time",
+    "finish_time",
+    "duration",
+    "distance",
+    "calories",
+    "heart_rate",
+    "max_heart_rate",
+    "cadence",
+    "laps",
+    "trackpoints",
+    "error",
+)
+# Number of the machine-readable records written at once
+INFO_BATCH = 256
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Scale, concatenate and modify TCX files",
+        epilog=f"Example: {sys.argv[0]} -m append_laps activity1.tcx activity2.tcx",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    # ----------------------
+    # -- Exclusive actions
+
+    action = parser.add_argument_group("actions")
+    action_ex = action.add_mutually_exclusive_group()
+    action_ex.add_argument(
+        "-i",
+        dest="info",
+        action="count",
+        help=textwrap.dedent(
+            """\
+            Output workout information.
+                -i  : Workout, lap and track info
+                -ii : Workout, lap, track and trackpoint info
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "-m",
+        dest="merge",
+        type=str,
+        choices=[*MERGE_KINDS, MERGE_STREAMS],
+        action="store",
+        help=textwrap.dedent(
+            """\
+            Merge multiple workouts into one workout.
+            Options:
+                append_laps  - Append all laps from all workouts into one workout 
+                merge_laps   - Merge all laps from all workouts into one lap
+                merge_tracks - Merge all tracks from all workouts into one lap with one track
+                merge_streams - Interleave overlapping recordings of one session
+                                from multiple devices, fusing the trackpoints
+            Example:
+                ./tcx.py -m merge_lap -o out.tcx f1.tcx f2.tcx f3.tcx 
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "-s",
+        dest="scale_factor",
+        nargs="?",
+        type=float,
+        help=textwrap.dedent(
+            """\
+            Scale duration, power, cadence and distance by the specified factor.
+            Multiple files or directories could be scaled at once
+            into the output directory (-d) or in place (--in-place).
+            Could be combined with --shift and --strip in one pass.
+            Example:
+                ./tcx.py -s 1.05 -j 0 -d scaled/ treadmill/
+                ./tcx.py -s 1.05 --shift 3600 --strip hr,position -o out.tcx in.tcx
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "--resample",
+        dest="resample",
+        choices=RESAMPLE_METHODS,
+        help=textwrap.dedent(
+            """\
+            Reduce trackpoint density of the workouts.
+            Options:
+                time            - Average power, cadence and HR over fixed
+                                  time buckets (see --interval)
+                douglas-peucker - Simplify the path keeping the points
+                                  further than --tolerance meters off it
+                visvalingam     - Simplify the path removing the points
+                                  with the area smaller than --tolerance squared
+            The first and the last trackpoints of each track are kept,
+            so the lap totals stay consistent.
+            Example:
+                ./tcx.py --resample time --interval 5 -o out.tcx ride.tcx
+            """
+        ),
+    )
+
+    action_ex.add_argument(
+        "--recompute-distance",
+        dest="recompute_distance",
+        choices=WorkoutDistance.METHODS,
+        help=textwrap.dedent(
+            """\
+            Recompute distance of the trackpoints and the laps from the positions,
+            e.g. of a ride recorded with a wrong wheel size (see --altitude).
+            Options:
+                haversine - Great-circle distance on the sphere
+                vincenty  - Distance on the WGS-84 ellipsoid, more precise, but iterated
+                            per point and several times slower
+            Example:
+                ./tcx.py --recompute-distance haversine -o out.tcx ride.tcx
+            """
+        ),
+    )
+
+    action_ex.add_argument(
+        "--split",
+        dest="split",
+        choices=WorkoutSplitter.KINDS,
+        help=textwrap.dedent(
+            """\
+            Split the workout into multiple workouts (see --at).
+            Options:
+                time     - At the given times, e.g. 2020-05-08T10:30:00Z
+                distance - At the given distances in meters
+                lap      - Before the given laps (from 0) or at every lap
+            Parts are written next to the output (-o) or into
+            the output directory (-d) with the number of the part
+            appended to the name, e.g. out-1.tcx, out-2.tcx.
+            Example:
+                ./tcx.py --split time --at 2020-05-08T10:30:00Z brick.tcx
+            """
+        ),
+    )
+
+    action_ex.add_argument(
+        "-a",
+        "--analyze",
+        dest="analyze",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Analyze power, cadence and heart rate: best 5s/1m/5m/20m efforts,
+            normalized power, variability index and, given FTP (--ftp),
+            intensity factor and TSS.
+            Example:
+                ./tcx.py -a --ftp 250 ride.tcx
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "--overlap",
+        dest="overlap",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Find all pairs of overlapping workouts among the files and directories,
+            e.g. the same workout uploaded from multiple devices.
+            Example:
+                ./tcx.py --overlap -j 0 archive/
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "--validate",
+        dest="validate",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Validate the files and directories against the TrainingCenterDatabase v2
+            schema (see --fail-fast). Exits with status 1 if any workout is invalid.
+            Example:
+                ./tcx.py --validate --fail-fast -j 0 incoming/
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "--index",
+        dest="index",
+        metavar="CATALOG",
+        help=textwrap.dedent(
+            """\
+            Index workout metadata of the files and directories
+            into the SQLite catalog. Only new and changed files are indexed.
+            Example:
+                ./tcx.py --index workouts.db -j 0 archive/
+            """
+        ),
+    )
+    action_ex.add_argument(
+        "--query",
+        dest="query",
+        metavar="CATALOG",
+        help=textwrap.dedent(
+            """\
+            Query workouts of the SQLite catalog (see --where, --order-by).
+            Example:
+                ./tcx.py --query workouts.db --where "activity = 'Biking'
+                    AND start_time >= '2020-03' AND distance > 40000"
+            """
+        ),
+    )
+
+    # --------------------
+    # -- Other arguments
+
+    parser.add_argument(
+        "-o", dest="output_file", nargs="?", help="Output TCX file",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--output-dir",
+        dest="output_dir",
+        help="Output directory for the actions that process multiple workouts",
+    )
+
+    parser.add_argument(
+        "--in-place",
+        dest="in_place",
+        action="store_true",
+        help="Overwrite input workouts with the results",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+            Number of worker processes used to process multiple input files.
+            Use 0 to run one worker per CPU core. Default: 1
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--unordered",
+        dest="unordered",
+        action="store_true",
+        help="Output the result for each file as soon as it is ready",
+    )
+
+    parser.add_argument(
+        "--fail-fast",
+        dest="fail_fast",
+        action="store_true",
+        help="Stop the validation at the first invalid workout",
+    )
+
+    parser.add_argument(
+        "--format",
+        dest="format",
+        choices=INFO_FORMATS,
+        default="text",
+        help=textwrap.dedent(
+            """\
+            Format of the workout information (-i):
+                text   - Human readable text. This is the default option.
+                json   - JSON array with an object per workout
+                ndjson - JSON object per workout per line
+                csv    - Row per workout with the workout totals
+            Example:
+                ./tcx.py -i --format ndjson -j 0 archive/ > archive.ndjson
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--shift",
+        dest="shift",
+        type=parse_shift,
+        metavar="SECONDS",
+        help=textwrap.dedent(
+            """\
+            Shift the workout in time by the seconds or [-]H:MM:SS,
+            e.g. --shift 3600 or --shift=-1:00:00
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--strip",
+        dest="strip",
+        metavar="FIELDS",
+        help=textwrap.dedent(
+            """\
+            Remove the comma separated fields from the workout:
+                {0}
+            """.format(
+                ", ".join(Strip.FIELDS)
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        type=float,
+        default=5.0,
+        help="Time bucket of the resampling in seconds. Default: 5",
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        default=5.0,
+        help="Path simplification tolerance in meters. Default: 5",
+    )
+
+    parser.add_argument(
+        "--altitude",
+        dest="altitude",
+        action="store_true",
+        help="Add the altitude changes to the recomputed distance",
+    )
+
+    parser.add_argument(
+        "--window",
+        dest="window",
+        metavar="SECONDS",
+        type=float,
+        default=1.0,
+        help=textwrap.dedent(
+            """\
+            Time window in seconds within which trackpoints of different devices
+            are fused by merge_streams. Default: 1
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--at",
+        dest="at",
+        help="Comma separated list of times, distances or laps to split at",
+    )
+
+    parser.add_argument(
+        "--ftp",
+        dest="ftp",
+        type=float,
+        help="Functional threshold power in watts used by the analysis",
+    )
+
+    parser.add_argument(
+        "--where",
+        dest="where",
+        help=textwrap.dedent(
+            """\
+            SQL condition of the query on the workout fields:
+                workout_id, activity, start_time, finish_time, duration,
+                distance, calories, heart_rate, max_heart_rate, cadence,
+                laps, trackpoints, path
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--order-by",
+        dest="order_by",
+        default="start_time",
+        help="SQL sort order of the query. Default: start_time",
+    )
+
+    parser.add_argument(
+        "--limit", dest="limit", type=int, help="Maximum number of queried workouts"
+    )
+
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        metavar="DIR",
+        help=textwrap.dedent(
+            """\
+            Cache the parsed workout summaries in the directory,
+            so the repeated info of unchanged files skips XML parsing.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=512,
+        metavar="MB",
+        help=textwrap.dedent(
+            """\
+            Size limit of the cache in megabytes,
+            least recently used entries are evicted. Default: 512
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Profile the action: wall and CPU time per phase
+            (read, parse, compute, serialize, write), number of laps
+            and trackpoints and peak memory allocated by Python (tracemalloc)
+            are reported as JSON to stderr.
+            Files are processed in a single process. Tracing of the memory
+            allocations slows down the action, compare the phases relatively.
+            """
+        ),
+    )
+
+    parser.add_argument(
+        "--profile-output",
+        dest="profile_output",
+        metavar="FILE",
+        help="Write the profiling report to the JSON file instead of stderr",
+    )
+
+    parser.add_argument(
+        "--cprofile",
+        dest="cprofile",
+        metavar="FILE",
+        help="Dump cProfile stats of the profiled action to the file",
+    )
+
+    parser.add_argument(
+        "input", type=str, nargs="*", help="Input TCX files or directories"
+    )
+
+    args = parser.parse_args()
+    if not args.input and args.query is None:
+        parser.error("the following arguments are required: input")
+    if args.strip is not None:
+        args.strip = [field.strip() for field in args.strip.split(",") if field.strip()]
+        unknown = [field for field in args.strip if field not in Strip.FIELDS]
+        if unknown:
+            parser.error(f"unknown fields to strip: {', '.join(unknown)}")
+    if args.shift is not None or args.strip:
+        actions = (args.info, args.merge, args.resample, args.split, args.index)
+        actions += (args.query, args.analyze or None, args.overlap or None)
+        actions += (args.validate or None, args.recompute_distance)
+        if any(action is not None for action in actions):
+            parser.error("--shift and --strip could be combined only with -s")
+    if args.split is not None:
+        try:
+            args.at = split_marks(args.split, args.at)
+        except ValueError as e:
+            parser.error(f"invalid split marks: {e}")
+        if args.at is None and args.split != WorkoutSplitter.LAP:
+            parser.error(f"split by {args.split} requires the marks (--at)")
+    if args.altitude and args.recompute_distance is None:
+        parser.error("--altitude could be used only with --recompute-distance")
+    if args.fail_fast and not args.validate:
+        parser.error("--fail-fast could be used only with --validate")
+    if args.format != "text" and args.info is None:
+        parser.error("--format could be used only with -i")
+    if args.interval <= 0 or args.tolerance < 0:
+        parser.error("resampling interval must be positive and tolerance not negative")
+    if args.window < 0:
+        parser.error("merge window must not be negative")
+    return args
+
+
+def handle_action(args):
+    """
+    """
+
+    # Output info
+    if args.info is not None:
+
+        options = dict(
+            verbose=args.info > 1,
+            jobs=args.jobs,
+            ordered=not args.unordered,
+            format=args.format,
+        )
+        if args.cache is not None:
+            options["cache"] = WorkoutCache(args.cache, args.cache_size * 1024 * 1024)
+
+        if args.output_file is None:
+            handle_info(args.input, **options)
+        else:
+            print(f"Saving output to {args.output_file}... ", end="", flush=True)
+            with open(args.output_file, "w") as f:
+                handle_info(args.input, stream=f, **options)
+            print("Done")
+
+    # Analyze workouts
+    elif args.analyze:
+        options = dict(ftp=args.ftp, jobs=args.jobs, ordered=not args.unordered)
+        if args.cache is not None:
+            options["cache"] = WorkoutCache(args.cache, args.cache_size * 1024 * 1024)
+
+        if args.output_file is None:
+            handle_analyze(args.input, **options)
+        else:
+            print(f"Saving output to {args.output_file}... ", end="", flush=True)
+            with open(args.output_file, "w") as f:
+                handle_analyze(args.input, stream=f, **options)
+            print("Done")
+
+    # Validate workouts
+    elif args.validate:
+        invalid = handle_validate(
+            args.input, args.jobs, not args.unordered, args.fail_fast
+        )
+        # Exit status is set by main, so the profile is still saved
+        if invalid:
+            return 1
+
+    # Find overlapping workouts
+    elif args.overlap:
+        handle_overlap(args.input, args.jobs)
+
+    # Index workouts
+    elif args.index is not None:
+        handle_index(args.input, args.index, args.jobs, not args.unordered)
+
+    # Query workouts
+    elif args.query is not None:
+        try:
+            handle_query(args.query, args.where, args.order_by, args.limit)
+        except sqlite3.Error as e:
+            print(f"Failed to query [{args.query}]: {e}")
+
+    # Merge workouts
+    elif args.merge is not None:
+        output = args.output_file if args.output_file is not None else "out.tcx"
+        print(
+            f"Merging [{', '.join(args.input)}] into [{output}]... ", end="", flush=True
+        )
+        if args.merge == MERGE_STREAMS:
+            handle_merge_streams(args.input, output, args.window)
+        else:
+            handle_merge(args.input, output, MERGE_KINDS[args.merge])
+        print("Done")
+
+    # Scale, shift and strip workouts
+    elif args.scale_factor is not None or args.shift is not None or args.strip:
+        options = dict(factor=args.scale_factor, shift=args.shift, strip=args.strip)
+        if args.shift is None and not args.strip:
+            action, verbs = "Scaling", ("scale", "Scaled")
+        else:
+            action, verbs = "Transforming", ("transform", "Transformed")
+
+        if args.output_dir is not None or args.in_place:
+            tasks = rewrite_tasks(args.input, args.output_dir, args.in_place)
+            handle_rewrite_all(
+                tasks, handle_transform, verbs, args.jobs, not args.unordered, **options
+            )
+            return
+
+        if len(args.input) > 1 or os.path.isdir(args.input[0]):
+            print(
+                f"{action} of multiple workouts is not supported:"
+                f" [{', '.join(args.input)}]."
+                " Please specify the output directory (-d) or use --in-place.\n",
+            )
+            return
+
+        output = args.output_file if args.output_file is not None else "out.tcx"
+        print(
+            f"{action} [{args.input[0]}] workout. Output: [{output}]... ",
+            end="",
+            flush=True,
+        )
+        handle_transform(args.input[0], output, **options)
+        print("Done")
+
+    # Split workouts
+    elif args.split is not None:
+        if len(args.input) > 1 or os.path.isdir(args.input[0]):
+            print(
+                "Splitting of multiple workouts is not supported:"
+                f" [{', '.join(args.input)}].\n",
+            )
+            return
+
+        output = args.output_file if args.output_file is not None else "out.tcx"
+        if args.output_dir is not None:
+            output = os.path.join(args.output_dir, os.path.basename(args.input[0]))
+
+        print(f"Splitting [{args.input[0]}] workout... ", end="", flush=True)
+        files = handle_split(args.input[0], output, args.split, args.at)
+        print(f"Done. Parts: [{', '.join(files)}]")
+
+    # Resample workouts
+    elif args.resample is not None:
+        options = dict(
+            method=args.resample, interval=args.interval, tolerance=args.tolerance
+        )
+        if args.output_dir is not None or args.in_place:
+            tasks = rewrite_tasks(args.input, args.output_dir, args.in_place)
+            handle_resample_all(tasks, args.jobs, not args.unordered, **options)
+            return
+
+        if len(args.input) > 1 or os.path.isdir(args.input[0]):
+            print(
+                "Resampling of multiple workouts is not supported:"
+                f" [{', '.join(args.input)}]."
+                " Please specify the output directory (-d) or use --in-place.\n",
+            )
+            return
+
+        output = args.output_file if args.output_file is not None else "out.tcx"
+        print(
+            f"Resampling [{args.input[0]}] workout. Output: [{output}]... ",
+            end="",
+            flush=True,
+        )
+        handle_resample(args.input[0], output, **options)
+        print("Done")
+
+    # Recompute distance of workouts
+    elif args.recompute_distance is not None:
+        options = dict(method=args.recompute_distance, altitude=args.altitude)
+        if args.output_dir is not None or args.in_place:
+            tasks = rewrite_tasks(args.input, args.output_dir, args.in_place)
+            verbs = ("recompute", "Recomputed")
+            handle_rewrite_all(
+                tasks,
+                handle_recompute_distance,
+                verbs,
+                args.jobs,
+                not args.unordered,
+                **options,
+            )
+            return
+
+        if len(args.input) > 1 or os.path.isdir(args.input[0]):
+            print(
+                "Recomputing distance of multiple workouts is not supported:"
+                f" [{', '.join(args.input)}]."
+                " Please specify the output directory (-d) or use --in-place.\n",
+            )
+            return
+
+        output = args.output_file if args.output_file is not None else "out.tcx"
+        print(
+            f"Recomputing distance of [{args.input[0]}]. Output: [{output}]... ",
+            end="",
+            flush=True,
+        )
+        try:
+            handle_recompute_distance(args.input[0], output, **options)
+        except ValueError as e:
+            print(f"Failed: {e}")
+            return
+        print("Done")
+
+
+def handle_analyze(
+    input, ftp=None, stream=sys.__stdout__, jobs=1, ordered=True, cache=None
+):
+    """
+    Outputs the analysis of each workout to the stream.
+    """
+    profiler = Profiler.current
+    results = run_parallel(file_analysis, input, jobs, ordered, ftp=ftp, cache=cache)
+    for analysis in results:
+        with profiler.phase("write"):
+            stream.write(analysis)
+            stream.flush()
+
+    if cache is not None:
+        cache.evict()
+
+
+def file_analysis(f, ftp=None, cache=None):
+    """
+    Renders the analysis of the workout file, or the failure message.
+    """
+    stream = StringIO()
+    print(f"==== {f} =======================================", file=stream)
+    try:
+        w = cache.get(f, columns=True) if cache is not None else None
+        if w is None:
+            w = WorkoutStream(f).summary(verbose=True)
+            if cache is not None:
+                cache.put(f, w)
+
+        with Profiler.current.phase("compute"):
+            analysis = WorkoutAnalysis.from_summary(w, ftp)
+        with Profiler.current.phase("serialize"):
+            analysis.info(stream=stream)
+    except Exception as e:
+        print(f"Failed to analyze {f} file. \n{e}\n\n", file=stream)
+    return stream.getvalue()
+
+
+def handle_overlap(input, jobs=1, stream=sys.__stdout__):
+    """
+    Outputs all pairs of overlapping workouts with the overlap duration.
+    """
+    files = [f for f, _ in find_workouts(input)]
+
+    intervals, failed = {}, 0
+    for f, start, finish, error in run_parallel(workout_interval, files, jobs):
+        if error is None:
+            intervals[f] = (start, finish)
+        else:
+            failed += 1
+            print(f"Failed to process [{f}]: {error}", file=stream)
+
+    pairs = 0
+    overlapping = Workout.overlapping(
+        (f, *interval) for f, interval in intervals.items()
+    )
+    for f, other, overlap in overlapping:
+        pairs += 1
+        shortest = min(
+            TCX.span(*intervals[f]), TCX.span(*intervals[other])
+        ).total_seconds()
+        share = overlap.total_seconds() / shortest if shortest else 1.0
+        print(
+            f"[{f}] and [{other}] overlap by {TCX.chop_ms(overlap)}"
+            + f" ({share:.0%} of the shorter workout)",
+            file=stream,
+        )
+
+    print(
+        f"Done. Workouts: {len(intervals)}, overlapping pairs: {pairs}, "
+        + f"failed: {failed}",
+        file=stream,
+    )
+
+
+def workout_interval(f):
+    """
+    Start and finish time of the workout file.
+    Returns (file, start time, finish time, error) tuple.
+    """
+    try:
+        summary = WorkoutHeader(f).summary()
+        return f, summary.start_time, summary.finish_time, None
+    except Exception as e:
+        return f, None, None, str(e)
+
+
+def handle_validate(
+    input, jobs=1, ordered=True, fail_fast=False, stream=sys.__stdout__
+):
+    """
+    Validates each workout against the TCX schema, reporting invalid files
+    with their errors. With 'fail_fast' stops at the first invalid workout.
+    Directories are expanded into the workout files they contain.
+    Returns the number of invalid workouts.
+    """
+    files = [f for f, _ in find_workouts(input)]
+
+    valid, invalid = 0, 0
+    with closing(run_parallel(validate_file, files, jobs, ordered)) as results:
+        for f, errors in results:
+            if not errors:
+                valid += 1
+                continue
+
+            invalid += 1
+            print(f"Invalid [{f}]:", file=stream)
+            for error in errors:
+                print(f"    {error}", file=stream)
+            stream.flush()
+            if fail_fast:
+                break
+
+    if fail_fast and invalid:
+        print("Stopped at the first invalid workout.", file=stream)
+    print(f"Done. Valid: {valid}, invalid: {invalid}", file=stream)
+    return invalid
+
+
+def validate_file(f):
+    """
+    Validates the workout file against the TCX schema.
+    Returns (file, errors) tuple, errors are empty for a valid workout.
+    """
+    try:
+        return f, WorkoutValidator().validate(f)
+    except Exception as e:
+        return f, [str(e)]
+
+
+def handle_index(input, catalog, jobs=1, ordered=True):
+    with WorkoutCatalog(catalog) as c:
+        c.index(input, jobs, ordered)
+
+
+def handle_query(catalog, where=None, order_by=None, limit=None, stream=sys.__stdout__):
+    """
+    Outputs workouts of the catalog matching the query.
+    """
+    with WorkoutCatalog(catalog) as c:
+        workouts = c.query(where, order_by, limit)
+
+    print(
+        f"{'Start time':<20} {'Activity':<10} {'Duration':>9} {'Distance':>12}"
+        + f" {'Calories':>9} {'Avg HR':>7}  Path",
+        file=stream,
+    )
+    for w in workouts:
+        duration = timedelta(seconds=round(w["duration"] or 0))
+        heart_rate = f"{w['heart_rate']:.0f}" if w["heart_rate"] else "-"
+        print(
+            f"{w['start_time'] or '-':<20} {w['activity'] or '-':<10}"
+            + f" {str(duration):>9} {w['distance'] or 0:>11,.1f}m"
+            + f" {w['calories'] or 0:>9,.0f} {heart_rate:>7}  {w['path']}",
+            file=stream,
+        )
+    print(f"Found: {len(workouts)}", file=stream)
+
+
+def handle_info(
+    input,
+    verbose=False,
+    stream=sys.__stdout__,
+    jobs=1,
+    ordered=True,
+    cache=None,
+    format="text",
+):
+    """
+    Outputs info of each workout to the stream in the format (see INFO_FORMATS).
+    With multiple jobs the files are processed by a pool of worker processes,
+    results are written in the input order, unless 'ordered' is False.
+    Summaries are read from and stored to the cache, if given.
+    Text is written file by file, machine-readable records in batches.
+    Directories are expanded into the workout files they contain.
+    """
+    profiler = Profiler.current
+    files = [f for f, _ in find_workouts(input)]
+    results = run_parallel(
+        file_info, files, jobs, ordered, verbose=verbose, cache=cache, format=format
+    )
+    if format == "text":
+        for info in results:
+            with profiler.phase("write"):
+                stream.write(info)
+                stream.flush()
+        if cache is not None:
+            cache.evict()
+        return
+
+    if format == "json":
+        head, separator, tail = "[\n", ",\n", "\n]\n"
+    elif format == "csv":
+        head, separator, tail = ",".join(INFO_CSV_FIELDS) + "\n", "", ""
+    else:
+        head, separator, tail = "", "", ""
+
+    buffer = [head]
+    for n, record in enumerate(results):
+        if n:
+            buffer.append(separator)
+        buffer.append(record)
+        if len(buffer) >= INFO_BATCH:
+            with profiler.phase("write"):
+                stream.write("".join(buffer))
+            buffer.clear()
+
+    buffer.append(tail)
+    with profiler.phase("write"):
+        stream.write("".join(buffer))
+        stream.flush()
+
+    if cache is not None:
+        cache.evict()
+
+
+def file_info(f, verbose=False, cache=None, format="text"):
+    """
+    Renders info of the workout file, or the failure message.
+    """
+    if format != "text":
+        return file_record(f, verbose, cache, format)
+
+    stream = StringIO()
+    print(f"==== {f} =======================================", file=stream)
+    try:
+        w = cache.get(f, columns=verbose) if cache is not None else None
+        if w is None:
+            w = WorkoutStream(f).summary(verbose=verbose)
+            if cache is not None:
+                cache.put(f, w)
+        with Profiler.current.phase("serialize"):
+            w.info(verbose=verbose, stream=stream)
+    except Exception as e:
+        print(f"Failed to process {f} file. \n{e}\n\n", file=stream)
+    return stream.getvalue()
+
+
+def file_record(f, verbose=False, cache=None, format="json"):
+    """
+    Renders info of the workout file, or the failure, as a JSON object,
+    a line of NDJSON or a CSV row (see INFO_CSV_FIELDS).
+    """
+    try:
+        w = cache.get(f, columns=verbose) if cache is not None else None
+        if w is None:
+            w = WorkoutStream(f).summary(verbose=verbose)
+            if cache is not None:
+                cache.put(f, w)
+        record = dict(file=f, **w.to_dict(verbose=verbose and format != "csv"))
+    except Exception as e:
+        record = dict(file=f, error=str(e))
+
+    with Profiler.current.phase("serialize"):
+        if format == "ndjson":
+            return json.dumps(record, separators=(",", ":")) + "\n"
+        if format == "json":
+            return json.dumps(record, indent=2)
+
+        if "laps" in record:
+            record["laps"] = len(record["laps"])
+        stream = StringIO()
+        csv.writer(stream, lineterminator="\n").writerow(
+            record.get(field) for field in INFO_CSV_FIELDS
+        )
+        return stream.getvalue()
+
+
+def run_parallel(func, items, jobs=1, ordered=True, **kwargs):
+    """
+    Applies the function to each item and yields the results.
+    With more than one job the items are distributed across a pool
+    of worker processes and every result is yielded as soon as it is ready,
+    keeping the order of the items if 'ordered' is True.
+    Closing the generator early cancels the items not yet started.
+    """
+    jobs = jobs if jobs > 0 else os.cpu_count() or 1
+    task = partial(func, **kwargs)
+
+    if jobs == 1 or len(items) < 2:
+        yield from map(task, items)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(items))) as pool:
+        if ordered:
+            chunksize = max(1, min(16, len(items) // (jobs * 4)))
+            yield from pool.map(task, items, chunksize=chunksize)
+        else:
+            futures = [pool.submit(task, item) for item in items]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+def handle_transform(input, output, factor=None, shift=None, strip=None):
+    """
+    Streams the workout through the pipeline of the transforms:
+    scales it by the factor, shifts by the seconds and strips the fields.
+    """
+    transforms = []
+    if factor is not None:
+        transforms.append(Scale(factor))
+    if shift:
+        transforms.append(Shift(shift))
+    if strip:
+        transforms.append(Strip(strip))
+    WorkoutStream(input).save(output, transform=Pipeline(transforms))
+
+
+def handle_resample(input, output, method="time", interval=5.0, tolerance=5.0):
+    """
+    Resamples the workout with the method (one of RESAMPLE_METHODS).
+    """
+    if method == "time":
+        resampler = TimeResampler(interval)
+    elif method == "douglas-peucker":
+        resampler = DouglasPeucker(tolerance)
+    elif method == "visvalingam":
+        resampler = Visvalingam(tolerance)
+    else:
+        raise ValueError(f"Unknown resampling method: {method}")
+
+    WorkoutStream(input).save(output, resampler=resampler)
+
+
+def handle_recompute_distance(input, output, method="haversine", altitude=False):
+    """
+    Recomputes distance of the workout from the positions
+    with the method (one of WorkoutDistance.METHODS).
+    """
+    WorkoutDistance(input, method, altitude).save(output)
+
+
+def handle_split(input, output, by, marks=None):
+    """
+    Splits the workout into the parts named after the output (see part_name).
+    Returns the list of written parts.
+    """
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return WorkoutSplitter(input, by, marks).split(partial(part_name, output))
+
+
+def parse_shift(text):
+    """
+    Parses time shift given in seconds or as [-+]H:MM:SS into seconds.
+    """
+    sign = -1 if text.startswith("-") else 1
+    seconds = 0.0
+    for part in text.lstrip("+-").split(":"):
+        seconds = seconds * 60 + float(part)
+    return sign * seconds
+
+
+def split_marks(by, marks):
+    """
+    Parses comma separated split marks: times into epoch seconds,
+    distances into meters and laps into lap numbers.
+    """
+    if not marks:
+        return None
+
+    parse = {
+        WorkoutSplitter.TIME: TCX.parse_epoch,
+        WorkoutSplitter.DISTANCE: float,
+        WorkoutSplitter.LAP: int,
+    }[by]
+    return [parse(mark.strip()) for mark in marks.split(",") if mark.strip()]
+
+
+def part_name(output, n):
+    """
+    Name of the n-th part of the output: the number is appended
+    to the name, keeping the extensions (e.g. 'ride-2.tcx.gz').
+    """
+    directory, name = os.path.split(output)
+    lower = name.lower()
+    for extension in WORKOUT_EXTENSIONS:
+        if lower.endswith(extension):
+            stem, extension = name[: -len(extension)], name[-len(extension) :]
+            break
+    else:
+        stem, extension = os.path.splitext(name)
+    return os.path.join(directory, f"{stem}-{n}{extension}")
+
+
+def handle_resample_all(tasks, jobs=1, ordered=True, stream=sys.__stdout__, **options):
+    """
+    Resamples each (input, output) workout pair, reporting progress per file.
+    """
+    verbs = ("resample", "Resampled")
+    handle_rewrite_all(tasks, handle_resample, verbs, jobs, ordered, stream, **options)
+
+
+def handle_rewrite_all(
+    tasks, rewrite, verbs, jobs=1, ordered=True, stream=sys.__stdout__, **kwargs
+):
+    """
+    Rewrites each (input, output) workout pair with the function,
+    reporting progress per file. The verbs name the action in the messages,
+    e.g. ('scale', 'Scaled').
+    """
+    verb, past = verbs
+    failed = 0
+    results = run_parallel(
+        rewrite_file, tasks, jobs, ordered, rewrite=rewrite, **kwargs
+    )
+    for n, (input, output, error) in enumerate(results, 1):
+        if error is None:
+            print(f"[{n}/{len(tasks)}] {past} [{input}] into [{output}]", file=stream)
+        else:
+            failed += 1
+            print(
+                f"[{n}/{len(tasks)}] Failed to {verb} [{input}]: {error}", file=stream
+            )
+        stream.flush()
+
+    print(f"Done. {past}: {len(tasks) - failed}, failed: {failed}", file=stream)
+
+
+def rewrite_file(task, rewrite, **kwargs):
+    """
+    Rewrites the workout file with 'rewrite(input, output=..., **kwargs)'.
+    The output is written to a temporary file next to the target first,
+    so the input could be safely rewritten in place.
+    Returns (input, output, error) tuple.
+    """
+    input, output = task
+    try:
+        directory = os.path.dirname(os.path.abspath(output))
+        os.makedirs(directory, exist_ok=True)
+
+        # Keep the name of the output as the suffix, so the temporary file
+        # is compressed the same way as the output
+        fd, temp = tempfile.mkstemp(
+            suffix="-" + os.path.basename(output), dir=directory
+        )
+        os.close(fd)
+        try:
+            rewrite(input, output=temp, **kwargs)
+            shutil.copymode(input, temp)
+            os.replace(temp, output)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return input, output, None
+    except Exception as e:
+        return input, output, str(e)
+
+
+def rewrite_tasks(input, output_dir=None, in_place=False):
+    """
+    Returns (input, output) pairs of the workouts found in the input,
+    rewritten into the output directory or in place.
+    """
+    return [
+        (f, f if in_place else os.path.join(output_dir, name))
+        for f, name in find_workouts(input)
+    ]
+
+
+def find_workouts(paths):
+    """
+    Expands the given files and directories into the list of workout files
+    (plain or compressed TCX).
+    Returns (path, name) tuples, where the name is relative to
+    the given directory or is the base name of the given file.
+    """
+    workouts = []
+    for path in paths:
+        if not os.path.isdir(path):
+            workouts.append((path, os.path.basename(path)))
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(WORKOUT_EXTENSIONS):
+                    f = os.path.join(root, name)
+                    workouts.append((f, os.path.relpath(f, path)))
+    return workouts
+
+
+def handle_merge(input, output, merge_kind=Workout.MergeKind.APPEND_LAPS):
+    with Profiler.current.phase("compute"):
+        w = Workout.merge_all(input, merge_kind=merge_kind)
+    w.save(output)
+
+
+def handle_merge_streams(input, output, window=1.0):
+    WorkoutMerger(input, window).merge(output)
 
 
 def main():
-    handle_action(parse_args())
+    args = parse_args()
+    if not args.profile:
+        sys.exit(handle_action(args))
+
+    # Phases and memory are measured in this process only
+    args.jobs = 1
+    with Profiler(cprofile=args.cprofile) as profiler:
+        status = handle_action(args)
+    profiler.save(args.profile_output, argv=sys.argv[1:], input=args.input)
+    sys.exit(status)
 
 
 if __name__ == "__main__":